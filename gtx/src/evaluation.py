@@ -103,7 +103,9 @@ def main():
     )
     data_collator = Evaluation_DataCollator(tokenizer=tokenizer,
                                             kg_special_token_ids=config.kg_special_token_ids,
-                                            task=training_args.task)
+                                            task=training_args.task,
+                                            # batches are concatenated into a single database below
+                                            dynamic_padding=False)
 
 
     model.to(training_args.device)
@@ -1,14 +1,17 @@
 
 # Base packages
+import json
 import logging
 import math
 import os
+import shutil
 from dataclasses import dataclass, field
 from glob import glob
 from typing import Optional
 from tqdm import tqdm
 import torch
-from torch.utils.data import ConcatDataset
+import torch.multiprocessing as mp
+from torch.utils.data import ConcatDataset, Subset
 from torch.utils.data.sampler import SequentialSampler
 from torch.utils.data.dataloader import DataLoader
 
@@ -35,6 +38,152 @@ logger = logging.getLogger(__name__)
 MODEL_CONFIG_CLASSES = list(MODEL_WITH_LM_HEAD_MAPPING.keys())
 MODEL_TYPES = tuple(conf.model_type for conf in MODEL_CONFIG_CLASSES)
 
+SHARD_OUTPUT_KEYS = ['prd_text', 'gt_text', 'gt_graph', 'ptb_graph']
+
+
+def get_dataloader(args, dataset, data_collator, num_workers=None):
+    sampler = SequentialSampler(dataset)
+    return DataLoader(
+        dataset,
+        sampler=sampler,
+        batch_size=args.per_device_eval_batch_size,
+        collate_fn=data_collator, 
+        drop_last=args.dataloader_drop_last,
+        num_workers=args.dataloader_num_workers if num_workers is None else num_workers,
+        pin_memory=True,
+    )
+
+
+def _prepare_inputs(inputs, device):
+    if isinstance(inputs, dict):
+        for k,v in inputs.items():
+            if isinstance(v, torch.Tensor):
+                inputs[k] = v.to(device)
+    return inputs
+
+
+def _unpad_outputs(output_ids, output_lengths):
+    # one device-to-host copy per batch, then cut each (beam of each) output at its length
+    output_ids, output_lengths = output_ids.cpu().tolist(), output_lengths.cpu().tolist()
+    if isinstance(output_lengths[0], list): # beam search
+        return [[o[:l] for o, l in zip(oo, ll)] for oo, ll in zip(output_ids, output_lengths)]
+    return [o[:l] for o, l in zip(output_ids, output_lengths)]
+
+
+def _saved_ranges(shard_path):
+    '''
+    (start, end, file name) of the batch outputs saved in shard_path, sorted by start
+    '''
+    saved_ranges = list()
+    for batch_file in os.listdir(shard_path):
+        if batch_file.endswith('.pt'):
+            start, end = os.path.splitext(batch_file)[0].split('-')
+            saved_ranges.append((int(start), int(end), batch_file))
+    return sorted(saved_ranges)
+
+
+def decode_shard(rank, model, dataset, data_collator, training_args, decode_option, shard_dir, num_shards, device):
+    '''
+    Decode the rank-th contiguous shard of the dataset.
+    Outputs of every batch are saved as {start}-{end}.pt as soon as they are decoded,
+    so that a restarted run continues right after the last saved batch, and a finished shard is marked by `done`.
+    Only saved batches which continue each other from the start of the shard are kept, others are removed.
+    '''
+    shard_path = os.path.join(shard_dir, f"shard{rank}")
+    os.makedirs(shard_path, exist_ok=True)
+    shard_start = len(dataset) * rank // num_shards
+    shard_end = len(dataset) * (rank + 1) // num_shards
+    
+    start = shard_start
+    for saved_start, saved_end, batch_file in _saved_ranges(shard_path):
+        if saved_start == start and saved_end <= shard_end:
+            start = saved_end
+        else:
+            os.remove(os.path.join(shard_path, batch_file))
+    done_file = os.path.join(shard_path, 'done')
+    if start == shard_end and os.path.isfile(done_file):
+        return
+    if os.path.isfile(done_file):
+        os.remove(done_file)
+    if num_shards > 1:
+        # split the cores among workers, rather than letting every worker spawn a thread per core
+        torch.set_num_threads(training_args.decode_num_threads or max(1, (os.cpu_count() or 1) // num_shards))
+    
+    if start > shard_start:
+        logger.info(f"shard {rank}: resume from example {start} (of {shard_start}-{shard_end})")
+    data_loader = get_dataloader(args=training_args,
+                                 dataset=Subset(dataset, range(start, shard_end)),
+                                 data_collator=data_collator,
+                                 num_workers=None if num_shards == 1 else 0)
+    
+    model.to(device)
+    model.eval()
+    with torch.no_grad():
+        for inputs in tqdm(data_loader, desc=f'Shard {rank}', position=rank):
+            inputs = _prepare_inputs(inputs, device)
+            outputs = model(**inputs, **decode_option)
+            
+            batch_outputs = {'prd_text': _unpad_outputs(output_ids=outputs[0], output_lengths=outputs[-1]),
+                             'gt_graph': list(outputs[1].cpu()),
+                             'gt_text': list(outputs[2].cpu()),
+                             'ptb_graph': list(outputs[3].cpu()) if len(outputs) == 5 and outputs[3] is not None else [],
+                             }
+            end = start + len(batch_outputs['gt_text'])
+            batch_file = os.path.join(shard_path, f"{start:09d}-{end:09d}.pt")
+            torch.save(batch_outputs, batch_file + '.tmp')
+            os.replace(batch_file + '.tmp', batch_file) # never leave a partially written batch behind
+            start = end
+    open(done_file, 'w').close()
+
+
+def decode_in_shards(model, dataset, data_collator, training_args, decode_option, shard_dir):
+    '''
+    Decode the dataset over training_args.num_decode_workers CPU processes (or in this process, if it is 0 or 1),
+    skipping shards already finished by a previous run, and merge the outputs in the dataset order.
+    Outputs of a previous run with another number of shards or another dataset size are removed, not resumed.
+    '''
+    num_shards = max(1, training_args.num_decode_workers)
+    manifest = {'num_shards': num_shards, 'num_examples': len(dataset)}
+    manifest_file = os.path.join(shard_dir, 'manifest.json')
+    if os.path.isdir(shard_dir):
+        saved_manifest = None
+        if os.path.isfile(manifest_file):
+            with open(manifest_file) as f:
+                saved_manifest = json.load(f)
+        if saved_manifest != manifest:
+            logger.info(f"outputs in {shard_dir} were decoded with {saved_manifest}, not {manifest}; remove them and decode from scratch")
+            shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f)
+    
+    decode_args = (model, dataset, data_collator, training_args, decode_option, shard_dir, num_shards)
+    if num_shards == 1:
+        decode_shard(0, *decode_args, training_args.device)
+    else:
+        logger.info(f"decode over {num_shards} worker processes, saving to {shard_dir}")
+        model.cpu()
+        mp.spawn(decode_shard, args=decode_args + (torch.device('cpu'),), nprocs=num_shards, join=True)
+    
+    saved_ranges = sorted((start, end, os.path.join(shard_dir, f"shard{rank}", batch_file))
+                          for rank in range(num_shards)
+                          for start, end, batch_file in _saved_ranges(os.path.join(shard_dir, f"shard{rank}")))
+    covered = 0
+    for start, end, batch_path in saved_ranges:
+        if start != covered:
+            raise ValueError(f"Decoded outputs in {shard_dir} {'overlap' if start < covered else 'miss examples'} at {batch_path} (expected start {covered})")
+        covered = end
+    if covered != len(dataset):
+        raise ValueError(f"Decoded outputs in {shard_dir} cover {covered} of {len(dataset)} examples")
+    
+    results = {k: [] for k in SHARD_OUTPUT_KEYS}
+    for _, _, batch_path in saved_ranges:
+        batch_outputs = torch.load(batch_path)
+        for k in SHARD_OUTPUT_KEYS:
+            results[k] += batch_outputs[k]
+    return results
+
+
 def main():
     # See all possible arguments in src/transformers/training_args.py
     # or by passing the --help flag to this script.
@@ -50,7 +199,11 @@ def main():
             raise ValueError("You have to add decode_option")
         decode_option['given_lang_tokens'] = int(decode_option['given_lang_tokens'])
         decode_option['search_beam_size'] = int(decode_option['search_beam_size'])
-        assert set(decode_option.keys()) == set(['perturb_type', 'given_lang_tokens', 'clean_outputs', 'given_gt_length', 'search_beam_size'])
+        if 'mask_predict_iterations' in decode_option:
+            decode_option['mask_predict_iterations'] = int(decode_option['mask_predict_iterations'])
+        required_keys = set(['perturb_type', 'given_lang_tokens', 'clean_outputs', 'given_gt_length', 'search_beam_size'])
+        optional_keys = set(['decode_type', 'mask_predict_iterations'])
+        assert required_keys <= set(decode_option.keys()) <= required_keys | optional_keys
         
     if data_args.eval_data_file is None and training_args.do_eval:
         raise ValueError(
@@ -152,23 +305,11 @@ def main():
         from utils.data_collator import UniLM_DataCollator
         data_collator = UniLM_DataCollator(tokenizer=tokenizer,
                                            kg_special_token_ids=config.kg_special_token_ids,
-                                           prediction=True)
+                                           prediction=True,
+                                           seed=training_args.seed)
     else:
         raise NotImplementedError("Not implemented task")
     
-    def get_dataloader(args, dataset, data_collator):
-        sampler = SequentialSampler(dataset)
-        return DataLoader(
-            dataset,
-            sampler=sampler,
-            batch_size=args.per_device_eval_batch_size,
-            collate_fn=data_collator, 
-            drop_last=args.dataloader_drop_last,
-            num_workers=args.dataloader_num_workers,
-            pin_memory=True,
-        )
-
-
     # *** Define Evaluate function ***
     def evaluate_for_generation(model,
                                 tokenizer,
@@ -200,13 +341,6 @@ def main():
         '''
         Helper function for evaluation
         ''' 
-        def _prepare_inputs(inputs, device):
-            if isinstance(inputs, dict):
-                for k,v in inputs.items():
-                    if isinstance(v, torch.Tensor):
-                        inputs[k] = v.to(device)
-            return inputs
-                
         def _prepare_outputs(outputs):
             if isinstance(outputs, list):
                 for i, o in enumerate(outputs):
@@ -214,24 +348,23 @@ def main():
                         outputs[i] = o.cpu()
             return outputs
             
+        # decode (per-batch outputs are kept on disk, so an interrupted run resumes where it stopped)
+        if len(results['gt_text']) == 0:
+            logger.info("start decoding...")
+            shard_dir = os.path.join(training_args.output_dir, f"{mode}_outputs_{save_file_suffix}_shards")
+            shard_results = decode_in_shards(model=model,
+                                             dataset=dataset,
+                                             data_collator=data_collator,
+                                             training_args=training_args,
+                                             decode_option=decode_option,
+                                             shard_dir=shard_dir)
+            for k, v in shard_results.items():
+                results[k] += v
+            
         device = training_args.device
         model.to(device)
         model.eval()
             
-        # decode
-        if len(results['gt_text']) == 0:
-            logger.info("start decoding...")
-            with torch.no_grad():
-                for idx, inputs in tqdm(enumerate(data_loader), total=len(data_loader), desc='Step'):
-                    inputs = _prepare_inputs(inputs, device)
-                    outputs = model(**inputs, **decode_option)
-                    
-                    results['prd_text'] += outputs[0]
-                    results['gt_graph'] += list(outputs[1])
-                    results['gt_text'] += list(outputs[2])
-                    if len(outputs) == 4:
-                        results['ptb_graph'] += list(outputs[3])
-            
         # compute metric: BLEU                
         if len(results['metric']['bleu']) == 0:        
             logger.info("start computing BLEU...")
@@ -244,8 +377,8 @@ def main():
                     hyp = tokenizer.convert_ids_to_tokens(results['gt_text'][idx], skip_special_tokens=True) # ground truth text
                     results['metric']['bleu'] += bleu_all([ref], hyp)
                 else:
-                    refs = [tokenizer.convert_ids_to_tokens(outputs[0][idx][k], skip_special_tokens=True) for k in range(K)] # generated text
-                    hyp = tokenizer.convert_ids_to_tokens(outputs[2][idx], skip_special_tokens=True) # ground truth text
+                    refs = [tokenizer.convert_ids_to_tokens(results['prd_text'][idx][k], skip_special_tokens=True) for k in range(K)] # generated text
+                    hyp = tokenizer.convert_ids_to_tokens(results['gt_text'][idx], skip_special_tokens=True) # ground truth text
                     results['metric']['bleu'] += bleu_all(refs, hyp)
         
         # compute metric: PPL
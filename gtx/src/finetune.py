@@ -5,7 +5,7 @@ import os
 from dataclasses import dataclass, field
 from glob import glob
 from typing import Optional
-from torch.utils.data import ConcatDataset
+from torch.utils.data import ConcatDataset, IterableDataset
 import torch
 
 # Own implementation
@@ -216,8 +216,10 @@ def main():
     train_dataset = get_dataset(data_args,
                                 tokenizer=tokenizer,
                                 token_type_vocab=config.token_type_vocab,
+                                seed=training_args.seed,
                                 )
-    logger.info(train_dataset[0])
+    if not isinstance(train_dataset, IterableDataset):
+        logger.info(train_dataset[0])
     eval_dataset = get_dataset(data_args,
                                 tokenizer=tokenizer,
                                 token_type_vocab=config.token_type_vocab,
@@ -249,7 +251,8 @@ def main():
     elif 'generation' in training_args.task: 
         from utils.data_collator import UniLM_DataCollator
         data_collator = UniLM_DataCollator(tokenizer=tokenizer,
-                                           kg_special_token_ids=config.kg_special_token_ids)
+                                           kg_special_token_ids=config.kg_special_token_ids,
+                                           seed=training_args.seed)
     else:
         raise NotImplementedError("Not implemented task")
     # Initialize our Trainer
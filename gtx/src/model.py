@@ -23,6 +23,7 @@ from typing import Optional, Tuple
 import torch
 from torch import nn
 from torch.nn import CrossEntropyLoss, MSELoss, SmoothL1Loss
+from torch.utils.checkpoint import checkpoint
 import torch.nn.functional as F
 
 from transformers.activations import ACT2FN, gelu
@@ -84,6 +85,10 @@ class GTXModelOutput(ModelOutput):
             Tuple of :obj:`torch.FloatTensor` (one for each layer) of shape :obj:`(batch_size, num_heads,
             sequence_length, sequence_length)`. Attentions weights after the attention softmax, used to compute the
             weighted average in the self-attention heads.
+        past_key_values (:obj:`dict`, `optional`, returned when ``use_cache=True`` is passed):
+            Keys/values of the language self-attentions (``'lang'``: one per language layer, ``'cross'``: one per
+            cross-modality layer), each a tuple of :obj:`torch.FloatTensor` of shape :obj:`(batch_size, num_heads,
+            sequence_length, head_size)`. Can be fed back to speed up incremental decoding.
     """
 
     language_output: Optional[torch.FloatTensor] = None
@@ -94,6 +99,57 @@ class GTXModelOutput(ModelOutput):
     language_attentions: Optional[Tuple[torch.FloatTensor]] = None
     kg_attentions: Optional[Tuple[torch.FloatTensor]] = None
     cross_encoder_attentions: Optional[Tuple[torch.FloatTensor]] = None
+    past_key_values: Optional[dict] = None
+
+@dataclass
+class GTXKGContext:
+    """
+    KG side encoded once by :meth:`GTXModel.encode_kg`. With the unilm type of x_attention the KG stream never attends
+    to the text, so that it can be reused across decoding steps (and shared by beams) to skip the KG branch.
+
+    Args:
+        hidden_states (:obj:`tuple(torch.FloatTensor)`):
+            KG hidden states of the relational layers and of each cross-modality layer, of shape :obj:`(batch_size,
+            kg_seq_length, hidden_size)`. The last one is the KG output, which is the only one kept unless
+            ``output_hidden_states=True`` is passed to :meth:`GTXModel.encode_kg`.
+        padding_mask (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, 1, 1, kg_seq_length)`):
+            Extended KG padding mask used by the language-to-KG cross attention.
+        key_values (:obj:`tuple(tuple(torch.FloatTensor))`):
+            Keys and values of the language-to-KG cross attention, one pair per cross-modality layer.
+    """
+
+    hidden_states: Tuple[torch.FloatTensor] = None
+    padding_mask: torch.FloatTensor = None
+    key_values: Tuple[Tuple[torch.FloatTensor]] = None
+
+    @property
+    def kg_output(self):
+        return self.hidden_states[-1]
+
+    def index_select(self, index):
+        """ Context of the selected batch items """
+        return GTXKGContext(
+            hidden_states=tuple(h.index_select(0, index) for h in self.hidden_states),
+            padding_mask=self.padding_mask.index_select(0, index),
+            key_values=tuple((k.index_select(0, index), v.index_select(0, index)) for k, v in self.key_values),
+        )
+
+@dataclass
+class GTXEdgeList:
+    """
+    Sparse KG attention structure, passed to the relational layers in place of a dense additive attention mask
+    (see ``config.kg_attention_layout``), so that attention scores are computed on the allowed (query, key) pairs only.
+
+    Args:
+        edge_index (:obj:`torch.LongTensor` of shape :obj:`(3, num_edges)`):
+            (sample, query node, key node) of each allowed pair, i.e. the nonzero entries of a
+            :obj:`(batch_size, kg_seq_length, kg_seq_length)` attention mask.
+        num_nodes (:obj:`int`):
+            kg_seq_length
+    """
+
+    edge_index: torch.LongTensor = None
+    num_nodes: int = None
 
 @dataclass
 class GTXForPreTrainingOutput(ModelOutput):
@@ -106,6 +162,8 @@ class GTXForPreTrainingOutput(ModelOutput):
             (classification) loss.
         prediction_logits (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, sequence_length, config.vocab_size)`):
             Prediction scores of the language modeling head (scores for each vocabulary token before SoftMax).
+            In training mode with labels, only the labeled positions are scored, so that the shape is
+            :obj:`(num_labeled_positions, config.vocab_size)` (likewise for the KG prediction logits).
         cross_relationship_score: (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, 2)`):
             Prediction scores of the textual matching objective (classification) head (scores of True/False
             continuation before SoftMax).
@@ -288,7 +346,7 @@ class GTXEmbeddings(nn.Module):
         self.LayerNorm = nn.LayerNorm(config.hidden_size, eps=1e-12)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, input_ids, token_type_ids=None, inputs_embeds=None):
+    def forward(self, input_ids, token_type_ids=None, inputs_embeds=None, past_key_values_length=0, position_ids=None):
         if input_ids is not None:
             input_shape = input_ids.size()
             device = input_ids.device
@@ -297,8 +355,9 @@ class GTXEmbeddings(nn.Module):
             device = inputs_embeds.device
         seq_length = input_shape[1]
 
-        position_ids = torch.arange(seq_length, dtype=torch.long, device=device)
-        position_ids = position_ids.unsqueeze(0).expand(input_shape)
+        if position_ids is None:
+            position_ids = torch.arange(past_key_values_length, past_key_values_length + seq_length, dtype=torch.long, device=device)
+            position_ids = position_ids.unsqueeze(0).expand(input_shape)
 
         if token_type_ids is None and self.token_type_embeddings is not None:
             token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=position_ids.device)
@@ -317,8 +376,110 @@ class GTXEmbeddings(nn.Module):
         return embeddings
 
 
+ATTENTION_BACKENDS = ['eager', 'sdpa', 'bool']
+
+
+def scaled_dot_product_attention(query_layer, key_layer, value_layer, attention_mask=None, dropout=None, backend='eager'):
+    """
+    Attention over already head-split query/key/value layers of shape (batch_size, num_heads, seq_length, head_size).
+    Shared by :class:`GTXAttention` and the incremental path of the HuggingFace layers swapped in by
+    :meth:`GTXEncoder.re_init_to_pretrained_lang_model`. Returns the context layer and the attention probabilities.
+    attention_mask is either additive (0 / -10000) or boolean (True to attend).
+    With the sdpa backend, PyTorch's fused kernel is used and the attention probabilities are not returned.
+    """
+    if backend == 'sdpa':
+        dropout_prob = dropout.p if dropout is not None and dropout.training else 0.0
+        context_layer = F.scaled_dot_product_attention(
+            query_layer, key_layer, value_layer, attn_mask=attention_mask, dropout_p=dropout_prob
+        )
+        return context_layer, None
+
+    # Take the dot product between "query" and "key" to get the raw attention scores.
+    attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+    attention_scores = attention_scores / math.sqrt(query_layer.size(-1))
+    # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
+    if attention_mask is not None and attention_mask.dtype == torch.bool:
+        attention_scores = attention_scores.masked_fill(~attention_mask, -10000.0)
+    elif attention_mask is not None:
+        attention_scores = attention_scores + attention_mask
+
+    # Normalize the attention scores to probabilities.
+    attention_probs = nn.Softmax(dim=-1)(attention_scores)
+
+    # This is actually dropping out entire tokens to attend to, which might
+    # seem a bit unusual, but is taken from the original Transformer paper.
+    if dropout is not None:
+        attention_probs = dropout(attention_probs)
+
+    context_layer = torch.matmul(attention_probs, value_layer)
+    return context_layer, attention_probs
+
+
+def chunked_scaled_dot_product_attention(
+    query_layer, key_layer, value_layer, attention_mask=None, dropout=None, chunk_size=256, backend='eager'
+):
+    """
+    :func:`scaled_dot_product_attention` over tiles of chunk_size queries, so that only a (batch_size, num_heads,
+    chunk_size, key_length) block of scores is alive at a time. Each query row is normalized over all keys as before,
+    so that the result is the same up to floating-point error. In training, each tile is recomputed in backward
+    (gradient checkpointing) instead of keeping its attention probabilities, which are thus not returned.
+    """
+    def attend(query_chunk, key_layer, value_layer, mask_chunk):
+        return scaled_dot_product_attention(
+            query_chunk, key_layer, value_layer, attention_mask=mask_chunk, dropout=dropout, backend=backend
+        )[0]
+
+    use_checkpoint = torch.is_grad_enabled() and any(x.requires_grad for x in (query_layer, key_layer, value_layer))
+    context_chunks = []
+    for start in range(0, query_layer.size(2), chunk_size):
+        query_chunk = query_layer[:, :, start:start+chunk_size]
+        mask_chunk = attention_mask
+        if attention_mask is not None and attention_mask.size(-2) > 1: # query-specific (e.g. causal) masks
+            mask_chunk = attention_mask[..., start:start+chunk_size, :]
+        if use_checkpoint:
+            context_chunks.append(checkpoint(attend, query_chunk, key_layer, value_layer, mask_chunk))
+        else:
+            context_chunks.append(attend(query_chunk, key_layer, value_layer, mask_chunk))
+    return torch.cat(context_chunks, dim=2), None
+
+
+def edge_list_attention(query_layer, key_layer, value_layer, edge_list, dropout=None):
+    """
+    Same as :func:`scaled_dot_product_attention` restricted to the pairs of a :class:`GTXEdgeList`, so that memory and
+    FLOPs scale with the number of edges rather than kg_seq_length ** 2. Returns the context layer and the attention
+    probabilities of shape (num_edges, num_heads). Nodes without any edge get a zero context.
+    """
+    batch_ids, query_ids, key_ids = edge_list.edge_index
+    batch_size, num_heads, num_nodes, head_size = query_layer.shape
+
+    # (num_edges, num_heads) scores of the allowed pairs only
+    attention_scores = (query_layer[batch_ids, :, query_ids] * key_layer[batch_ids, :, key_ids]).sum(dim=-1)
+    attention_scores = attention_scores / math.sqrt(head_size)
+
+    # softmax over the edges of each query node
+    query_index = (batch_ids * num_nodes + query_ids).unsqueeze(1).expand(-1, num_heads)
+    if hasattr(attention_scores, 'scatter_reduce'):
+        max_scores = attention_scores.new_full((batch_size * num_nodes, num_heads), float('-inf'))
+        max_scores = max_scores.scatter_reduce(0, query_index, attention_scores, reduce='amax', include_self=True)
+        max_scores = max_scores.gather(0, query_index)
+    else:
+        max_scores = attention_scores.max(dim=0, keepdim=True)[0]
+    attention_probs = torch.exp(attention_scores - max_scores)
+    normalizer = attention_probs.new_zeros(batch_size * num_nodes, num_heads).index_add_(0, query_index[:, 0], attention_probs)
+    attention_probs = attention_probs / normalizer.gather(0, query_index).clamp(min=1e-12)
+
+    if dropout is not None:
+        attention_probs = dropout(attention_probs)
+
+    weighted_values = attention_probs.unsqueeze(-1) * value_layer[batch_ids, :, key_ids]
+    context_layer = value_layer.new_zeros(batch_size * num_nodes, num_heads, head_size)
+    context_layer = context_layer.index_add_(0, query_index[:, 0], weighted_values)
+    context_layer = context_layer.view(batch_size, num_nodes, num_heads, head_size).permute(0, 2, 1, 3)
+    return context_layer, attention_probs
+
+
 class GTXAttention(nn.Module):
-    def __init__(self, config, ctx_dim=None):
+    def __init__(self, config, ctx_dim=None, self_attention=False):
         super().__init__()
         if config.hidden_size % config.num_attention_heads != 0:
             raise ValueError(
@@ -332,12 +493,31 @@ class GTXAttention(nn.Module):
         # visual_dim = 2048
         if ctx_dim is None:
             ctx_dim = config.hidden_size
-        self.query = nn.Linear(config.hidden_size, self.head_size)
-        self.key = nn.Linear(ctx_dim, self.head_size)
-        self.value = nn.Linear(ctx_dim, self.head_size)
+        # Self attention projects queries/keys/values with one matmul (config.fused_qkv, off by default, as it stores
+        # a single qkv projection in checkpoints instead of query/key/value)
+        self.fused_qkv = self_attention and (config.fused_qkv if 'fused_qkv' in vars(config).keys() else False)
+        if self.fused_qkv:
+            self.qkv = nn.Linear(config.hidden_size, 3 * self.head_size)
+            self._register_load_state_dict_pre_hook(self._fuse_qkv_state_dict)
+        else:
+            self.query = nn.Linear(config.hidden_size, self.head_size)
+            self.key = nn.Linear(ctx_dim, self.head_size)
+            self.value = nn.Linear(ctx_dim, self.head_size)
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
 
+        # eager: softmax attention with additive masks / sdpa: PyTorch's fused kernel (eager if not available)
+        # bool: eager with boolean masks, which GTXModel builds for the KG side instead of float additive masks
+        self.attention_backend = config.attention_backend if 'attention_backend' in vars(config).keys() else 'eager'
+        if self.attention_backend not in ATTENTION_BACKENDS:
+            raise NotImplementedError("not implemented yet, a such kind of attention backend:", self.attention_backend)
+        if self.attention_backend == 'sdpa' and not hasattr(F, 'scaled_dot_product_attention'):
+            logger.info("scaled_dot_product_attention is not available in this version of PyTorch, so use eager attention")
+            self.attention_backend = 'eager'
+
+        # attend over tiles of queries for long (e.g. KG) sequences, not to hold the whole score matrix (0: off)
+        self.attention_chunk_size = config.attention_chunk_size if 'attention_chunk_size' in vars(config).keys() else 0
+
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (
             self.num_attention_heads,
@@ -346,35 +526,103 @@ class GTXAttention(nn.Module):
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
 
-    def forward(self, hidden_states, context, attention_mask=None, output_attentions=False):
-        mixed_query_layer = self.query(hidden_states)
-        mixed_key_layer = self.key(context)
-        mixed_value_layer = self.value(context)
-
-        query_layer = self.transpose_for_scores(mixed_query_layer)
-        key_layer = self.transpose_for_scores(mixed_key_layer)
-        value_layer = self.transpose_for_scores(mixed_value_layer)
+    def _fuse_qkv_state_dict(self, state_dict, prefix, *args):
+        """ Map separate query/key/value weights of older checkpoints into the fused projection """
+        for param in ['weight', 'bias']:
+            keys = [f"{prefix}{name}.{param}" for name in ['query', 'key', 'value']]
+            if all(k in state_dict for k in keys):
+                state_dict[f"{prefix}qkv.{param}"] = torch.cat([state_dict.pop(k) for k in keys], dim=0)
+
+    def project_query(self, hidden_states):
+        if self.fused_qkv:
+            return F.linear(hidden_states, self.qkv.weight[:self.head_size], self.qkv.bias[:self.head_size])
+        return self.query(hidden_states)
+
+    def project_key_value(self, context):
+        """ Keys and values of a fixed context, which can be passed to forward() as context_key_value """
+        if self.fused_qkv:
+            mixed_key_layer, mixed_value_layer = F.linear(
+                context, self.qkv.weight[self.head_size:], self.qkv.bias[self.head_size:]
+            ).split(self.head_size, dim=-1)
+        else:
+            mixed_key_layer, mixed_value_layer = self.key(context), self.value(context)
+        return self.transpose_for_scores(mixed_key_layer), self.transpose_for_scores(mixed_value_layer)
 
-        # Take the dot product between "query" and "key" to get the raw attention scores.
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-        # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
-        if attention_mask is not None:
-            attention_scores = attention_scores + attention_mask
+    def forward(
+        self,
+        hidden_states,
+        context,
+        attention_mask=None,
+        output_attentions=False,
+        past_key_value=None,
+        use_cache=False,
+        context_key_value=None,
+    ):
+        if self.fused_qkv and context is hidden_states and context_key_value is None:
+            mixed_query_layer, mixed_key_layer, mixed_value_layer = self.qkv(hidden_states).split(self.head_size, dim=-1)
+            key_layer, value_layer = self.transpose_for_scores(mixed_key_layer), self.transpose_for_scores(mixed_value_layer)
+        else:
+            mixed_query_layer = self.project_query(hidden_states)
+            if context_key_value is not None:
+                key_layer, value_layer = context_key_value
+            else:
+                key_layer, value_layer = self.project_key_value(context)
 
-        # Normalize the attention scores to probabilities.
-        attention_probs = nn.Softmax(dim=-1)(attention_scores)
+        # Several queries (e.g. beams of a batch item) can share one context without copying it:
+        # consecutive rows are folded into the sequence axis, as each query row attends independently.
+        batch_size, num_repeats = hidden_states.size(0), hidden_states.size(0) // key_layer.size(0)
+        if num_repeats > 1:
+            mixed_query_layer = mixed_query_layer.view(key_layer.size(0), -1, self.head_size)
 
-        # This is actually dropping out entire tokens to attend to, which might
-        # seem a bit unusual, but is taken from the original Transformer paper.
-        attention_probs = self.dropout(attention_probs)
+        query_layer = self.transpose_for_scores(mixed_query_layer)
 
-        context_layer = torch.matmul(attention_probs, value_layer)
+        # Incremental (causal) decoding: prepend keys/values cached from the previous positions
+        if past_key_value is not None:
+            key_layer = torch.cat([past_key_value[0], key_layer], dim=2)
+            value_layer = torch.cat([past_key_value[1], value_layer], dim=2)
+
+        if isinstance(attention_mask, GTXEdgeList):
+            context_layer, attention_probs = edge_list_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attention_mask,
+                dropout=self.dropout,
+            )
+        elif self.attention_chunk_size and query_layer.size(2) > self.attention_chunk_size and not output_attentions:
+            context_layer, attention_probs = chunked_scaled_dot_product_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attention_mask=attention_mask,
+                dropout=self.dropout,
+                chunk_size=self.attention_chunk_size,
+                backend=self.attention_backend,
+            )
+        else:
+            context_layer, attention_probs = scaled_dot_product_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attention_mask=attention_mask,
+                dropout=self.dropout,
+                # attention probabilities are only given by the eager math
+                backend='eager' if output_attentions else self.attention_backend,
+            )
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.head_size,)
         context_layer = context_layer.view(*new_context_layer_shape)
 
+        if num_repeats > 1:
+            context_layer = context_layer.view(batch_size, -1, self.head_size)
+            if output_attentions:
+                probs_shape = attention_probs.size()
+                attention_probs = attention_probs.view(probs_shape[0], probs_shape[1], num_repeats, -1, probs_shape[-1])
+                attention_probs = attention_probs.transpose(1, 2).reshape(batch_size, probs_shape[1], -1, probs_shape[-1])
+
         outputs = (context_layer, attention_probs) if output_attentions else (context_layer,)
+        if use_cache:
+            outputs = outputs + ((key_layer, value_layer),)
         return outputs
 
 
@@ -398,8 +646,14 @@ class GTXCrossAttentionLayer(nn.Module):
         self.att = GTXAttention(config)
         self.output = GTXAttentionOutput(config)
 
-    def forward(self, input_tensor, ctx_tensor, ctx_att_mask=None, output_attentions=False):
-        output = self.att(input_tensor, ctx_tensor, ctx_att_mask, output_attentions=output_attentions)
+    def forward(self, input_tensor, ctx_tensor, ctx_att_mask=None, output_attentions=False, ctx_key_value=None):
+        output = self.att(
+            input_tensor,
+            ctx_tensor,
+            ctx_att_mask,
+            output_attentions=output_attentions,
+            context_key_value=ctx_key_value,
+        )
         if output_attentions:
             attention_probs = output[1]
         attention_output = self.output(output[0], input_tensor)
@@ -410,21 +664,21 @@ class GTXCrossAttentionLayer(nn.Module):
 class GTXSelfAttentionLayer(nn.Module):
     def __init__(self, config):
         super().__init__()
-        self.self = GTXAttention(config)
+        self.self = GTXAttention(config, self_attention=True)
         self.output = GTXAttentionOutput(config)
 
-    def forward(self, input_tensor, attention_mask, output_attentions=False):
+    def forward(self, input_tensor, attention_mask, output_attentions=False, past_key_value=None, use_cache=False):
         # Self attention attends to itself, thus keys and querys are the same (input_tensor).
         output = self.self(
             input_tensor,
             input_tensor,
             attention_mask,
             output_attentions=output_attentions,
+            past_key_value=past_key_value,
+            use_cache=use_cache,
         )
-        if output_attentions:
-            attention_probs = output[1]
         attention_output = self.output(output[0], input_tensor)
-        outputs = (attention_output, attention_probs) if output_attentions else (attention_output,)
+        outputs = (attention_output,) + output[1:]  # add attentions and present key/values if we output them
         return outputs
 
 class GTXIntermediate(nn.Module):
@@ -460,12 +714,18 @@ class GTXLayer(nn.Module):
         self.intermediate = GTXIntermediate(config)
         self.output = GTXOutput(config)
 
-    def forward(self, hidden_states, attention_mask=None, output_attentions=False):
-        outputs = self.attention(hidden_states, attention_mask, output_attentions=output_attentions)
+    def forward(self, hidden_states, attention_mask=None, output_attentions=False, past_key_value=None, use_cache=False):
+        outputs = self.attention(
+            hidden_states,
+            attention_mask,
+            output_attentions=output_attentions,
+            past_key_value=past_key_value,
+            use_cache=use_cache,
+        )
         attention_output = outputs[0]
         intermediate_output = self.intermediate(attention_output)
         layer_output = self.output(intermediate_output, attention_output)
-        outputs = (layer_output,) + outputs[1:]  # add attentions if we output them
+        outputs = (layer_output,) + outputs[1:]  # add attentions and present key/values if we output them
         return outputs
 
 class GTXXLayer(nn.Module):
@@ -549,11 +809,67 @@ class GTXXLayer(nn.Module):
         visual_att_output = (visual_input, None) if output_x_attentions else (visual_input,)
         return lang_att_output, visual_att_output
 
-    def self_att(self, lang_input, lang_attention_mask, visual_input, visual_attention_mask):
+    def self_att(
+        self,
+        lang_input,
+        lang_attention_mask,
+        visual_input,
+        visual_attention_mask,
+        past_key_value=None,
+        use_cache=False,
+    ):
         # Self Attention
-        lang_att_output = self.lang_self_att(lang_input, lang_attention_mask, output_attentions=False)
+        lang_att_output = self.lang_self_att(
+            lang_input,
+            lang_attention_mask,
+            output_attentions=False,
+            past_key_value=past_key_value,
+            use_cache=use_cache,
+        )
         visual_att_output = self.visn_self_att(visual_input, visual_attention_mask, output_attentions=False)
-        return lang_att_output[0], visual_att_output[0]
+        # present key/values of the language self attention come last when use_cache
+        return (lang_att_output[0], visual_att_output[0]) + lang_att_output[1:]
+
+    def lang_only_forward(
+        self,
+        lang_feats,
+        lang_attention_mask,
+        visual_key_value,
+        visual_padding_mask,
+        output_attentions=False,
+        past_key_value=None,
+        use_cache=False,
+    ):
+        """ Language half of the unilm type of layer, attending to pre-computed keys/values of the KG side """
+        lang_att_output = self.cross_attention(
+            lang_feats,
+            None,
+            ctx_att_mask=visual_padding_mask,
+            output_attentions=output_attentions,
+            ctx_key_value=visual_key_value,
+        )
+        attention_probs = {'txt->kg':lang_att_output[-1],
+                           'kg->txt':None}
+        lang_self_output = self.lang_self_att(
+            lang_att_output[0],
+            lang_attention_mask,
+            output_attentions=False,
+            past_key_value=past_key_value,
+            use_cache=use_cache,
+        )
+        lang_inter_output = self.lang_inter(lang_self_output[0])
+        lang_output = self.lang_output(lang_inter_output, lang_self_output[0])
+
+        outputs = (lang_output, attention_probs) if output_attentions else (lang_output,)
+        if use_cache:
+            outputs = outputs + (lang_self_output[-1],)
+        return outputs
+
+    def visn_only_forward(self, visual_feats, visual_attention_mask):
+        """ KG half of the unilm type of layer, which does not depend on the language part """
+        visual_att_output = self.visn_self_att(visual_feats, visual_attention_mask, output_attentions=False)[0]
+        visual_inter_output = self.visn_inter(visual_att_output)
+        return self.visn_output(visual_inter_output, visual_att_output)
 
     def output_fc(self, lang_input, visual_input):
         # FC layers
@@ -574,7 +890,12 @@ class GTXXLayer(nn.Module):
         visual_attention_mask,
         visual_padding_mask,
         output_attentions=False,
+        past_key_value=None,
+        use_cache=False,
     ):
+        if use_cache and self.cross_att_type != 'unilm':
+            raise ValueError("Caching key/values of the language part is only supported for the unilm type of x_attention")
+
         if self.cross_att_type == 'single':
             lang_att_output, visual_att_output = self.no_cross_att(
                 lang_input=lang_feats,
@@ -602,15 +923,18 @@ class GTXXLayer(nn.Module):
         attention_probs = {'txt->kg':lang_att_output[-1],
                            'kg->txt':visual_att_output[-1]}
         
-        lang_att_output, visual_att_output = self.self_att(
+        self_att_outputs = self.self_att(
             lang_att_output[0],
             lang_attention_mask,
             visual_att_output[0],
             visual_attention_mask,
+            past_key_value=past_key_value,
+            use_cache=use_cache,
         )
+        lang_att_output, visual_att_output = self_att_outputs[:2]
 
         lang_output, visual_output = self.output_fc(lang_att_output, visual_att_output)
-        return (
+        outputs = (
             (
                 lang_output,
                 visual_output,
@@ -619,6 +943,9 @@ class GTXXLayer(nn.Module):
             if output_attentions
             else (lang_output, visual_output)
         )
+        if use_cache:
+            outputs = outputs + (self_att_outputs[2],)
+        return outputs
 
 
 # class GTXKGFeatureEncoder(nn.Module):
@@ -641,6 +968,7 @@ class GTXEncoder(nn.Module):
             logger.info("You have not specific encoder type in config, so that you don't use any kinds of LSTM")
             self.config.encoder_type = {'lang': ''}
         self.encoder_type = self.config.encoder_type['lang'].lower()
+        self.cross_att_type = config.cross_att_type if 'cross_att_type' in vars(config).keys() else 'cross'
 
         # Number of layers
         self.num_l_layers = config.l_layers
@@ -652,6 +980,14 @@ class GTXEncoder(nn.Module):
         self.layer = nn.ModuleList([GTXLayer(config) for _ in range(self.num_l_layers)])
         self.x_layers = nn.ModuleList([GTXXLayer(config) for _ in range(self.num_x_layers)])
         self.r_layers = nn.ModuleList([GTXLayer(config) for _ in range(self.num_r_layers)])
+
+        # Gradient checkpointing, either a bool for all stacks or a dict such as {'lang': True, 'kg': True, 'cross': False}
+        gradient_checkpointing = config.gradient_checkpointing if 'gradient_checkpointing' in vars(config).keys() else False
+        if not isinstance(gradient_checkpointing, dict):
+            gradient_checkpointing = {stack: gradient_checkpointing for stack in ['lang', 'kg', 'cross']}
+        self.gradient_checkpointing = {stack: bool(gradient_checkpointing.get(stack, False)) for stack in ['lang', 'kg', 'cross']}
+        if any(self.gradient_checkpointing.values()):
+            logger.info(f"Use gradient checkpointing for {[k for k, v in self.gradient_checkpointing.items() if v]} layers")
         
         # Lang Encoder Architecture
         # LSTM for generation, BiLSTM for pretraining/other donwstream tasks
@@ -693,6 +1029,123 @@ class GTXEncoder(nn.Module):
         else:
             raise NotImplementedError("not implemented yet, a such kind of architecture for language encoder:", self.encoder_type)
         
+    def checkpointed_forward(self, stack, layer_forward, *feats):
+        """
+        Run layer_forward(*feats), and recompute its activations in backward instead of keeping them,
+        if gradient checkpointing is enabled for the stack ('lang', 'kg' or 'cross') in training.
+        Masks and flags must be bound in layer_forward, so that only the hidden states go through checkpoint.
+        The layer module itself has to be bound as well (e.g. as a default argument), since it is re-run in backward.
+        Decoding with key/value caches runs in eval mode, so that it is never checkpointed.
+        """
+        if not (self.training and self.gradient_checkpointing[stack]) or not torch.is_grad_enabled():
+            return layer_forward(*feats)
+
+        # checkpoint only returns flat outputs, so that attention dicts of cross-modality layers are flattened and rebuilt
+        structure = []
+        def custom_forward(*inputs):
+            structure.clear()
+            flat_outputs = ()
+            for output in layer_forward(*inputs):
+                if isinstance(output, dict):
+                    structure.append(list(output.keys()))
+                    flat_outputs = flat_outputs + tuple(output.values())
+                else:
+                    structure.append(None)
+                    flat_outputs = flat_outputs + (output,)
+            return flat_outputs
+
+        flat_outputs = checkpoint(custom_forward, *feats)
+        outputs, idx = (), 0
+        for keys in structure:
+            if keys is None:
+                outputs = outputs + (flat_outputs[idx],)
+                idx += 1
+            else:
+                outputs = outputs + (dict(zip(keys, flat_outputs[idx:idx + len(keys)])),)
+                idx += len(keys)
+        return outputs
+
+    @staticmethod
+    def get_lang_lengths(lang_attention_mask):
+        """
+        Number of non-padded (right-padded) language tokens from the extended additive mask, whose last query row
+        attends to every real token even with causal masking.
+        """
+        return (lang_attention_mask[:, 0, -1] > -1.0).sum(-1).clamp(min=1)
+
+    def packed_rnn_forward(self, lang_feats, lang_lengths):
+        """ Run the RNN encoder on packed sequences, so that padding is neither computed nor fed to the backward direction """
+        packed_feats = nn.utils.rnn.pack_padded_sequence(
+            lang_feats, lang_lengths.cpu(), batch_first=True, enforce_sorted=False
+        )
+        packed_outputs, _ = self.layer(packed_feats)
+        lang_outputs, _ = nn.utils.rnn.pad_packed_sequence(packed_outputs, batch_first=True, total_length=lang_feats.size(1))
+        return lang_outputs
+
+    @property
+    def supports_cache(self):
+        """ Whether the language part can be decoded incrementally with cached key/values """
+        return self.cross_att_type == 'unilm' and self.encoder_type not in ['bilstm', 'lstm']
+
+    def lang_layer_with_cache(self, layer_module, lang_feats, lang_attention_mask, past_key_value=None):
+        """
+        Incremental forward of one language layer, which returns (layer_output, present key/values).
+        HuggingFace layers swapped in by re_init_to_pretrained_lang_model do not take key/value caches,
+        so that their sub-modules are run here in the same way as GTXLayer.
+        """
+        if isinstance(layer_module, GTXLayer):
+            l_outputs = layer_module(lang_feats, lang_attention_mask, past_key_value=past_key_value, use_cache=True)
+            return l_outputs[0], l_outputs[-1]
+
+        self_att = layer_module.attention.self
+        query_layer = self_att.transpose_for_scores(self_att.query(lang_feats))
+        key_layer = self_att.transpose_for_scores(self_att.key(lang_feats))
+        value_layer = self_att.transpose_for_scores(self_att.value(lang_feats))
+        if past_key_value is not None:
+            key_layer = torch.cat([past_key_value[0], key_layer], dim=2)
+            value_layer = torch.cat([past_key_value[1], value_layer], dim=2)
+
+        context_layer, _ = scaled_dot_product_attention(
+            query_layer,
+            key_layer,
+            value_layer,
+            attention_mask=lang_attention_mask,
+            dropout=self_att.dropout,
+        )
+        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+        context_layer = context_layer.view(*(context_layer.size()[:-2] + (self_att.all_head_size,)))
+
+        attention_output = layer_module.attention.output(context_layer, lang_feats)
+        layer_output = layer_module.output(layer_module.intermediate(attention_output), attention_output)
+        return layer_output, (key_layer, value_layer)
+
+    def encode_kg(self, kg_feats, kg_attention_mask, kg_padding_mask, output_hidden_states=False):
+        """
+        Run the KG branch once (relational layers and the KG half of each cross-modality layer) and return a
+        GTXKGContext, which can be passed to forward() as kg_context to skip the KG branch.
+        Without output_hidden_states, only the KG output is kept in the context.
+        Only possible for the unilm type of x_attention, where the KG side does not attend to the language part.
+        """
+        if self.cross_att_type != 'unilm':
+            raise ValueError(f"KG side depends on the language part with the {self.cross_att_type} type of x_attention")
+
+        kg_hidden_states = ()
+        for layer_module in self.r_layers:
+            kg_feats = layer_module(kg_feats, kg_attention_mask)[0]
+            if output_hidden_states:
+                kg_hidden_states = kg_hidden_states + (kg_feats,)
+
+        key_values = ()
+        for layer_module in self.x_layers:
+            key_values = key_values + (layer_module.cross_attention.att.project_key_value(kg_feats),)
+            kg_feats = layer_module.visn_only_forward(kg_feats, kg_padding_mask)
+            if output_hidden_states:
+                kg_hidden_states = kg_hidden_states + (kg_feats,)
+
+        if not output_hidden_states:
+            kg_hidden_states = (kg_feats,)
+        return GTXKGContext(hidden_states=kg_hidden_states, padding_mask=kg_padding_mask, key_values=key_values)
+
     def forward(
         self,
         lang_feats,
@@ -701,7 +1154,21 @@ class GTXEncoder(nn.Module):
         kg_attention_mask,
         kg_padding_mask,
         output_attentions=None,
+        past_key_values=None,
+        use_cache=False,
+        kg_context=None,
+        output_hidden_states=False,
     ):
+        """
+        Hidden states of every layer are collected only with output_hidden_states. Otherwise, only the running states
+        are kept, and the returned hidden states are 1-tuples of the last layer outputs.
+        """
+        if use_cache and not self.supports_cache:
+            raise ValueError(
+                "Key/value caching needs the unilm type of x_attention and a transformer language encoder, "
+                f"but got {self.cross_att_type} / {self.encoder_type}"
+            )
+        present_key_values = {'lang': (), 'cross': ()} if use_cache else None
 
         kg_hidden_states = ()
         language_hidden_states = ()
@@ -712,44 +1179,102 @@ class GTXEncoder(nn.Module):
         # Run language layers
         ## use RNN Encoder
         if self.encoder_type in ['bilstm', 'lstm']:
-            l_outputs = self.layer(lang_feats)
+            lang_lengths = self.get_lang_lengths(lang_attention_mask)
+            l_outputs = self.checkpointed_forward(
+                'lang',
+                lambda feats: (self.packed_rnn_forward(feats, lang_lengths),),
+                lang_feats,
+            )
             lang_feats = l_outputs[0]
             if self.layer.bidirectional:
                 bsz, seq_len = lang_feats.shape[0], lang_feats.shape[1]
                 lang_feats = lang_feats.view(bsz, seq_len, 2, -1).sum(axis=2)
-            language_hidden_states = language_hidden_states + (lang_feats,)
+            if output_hidden_states:
+                language_hidden_states = language_hidden_states + (lang_feats,)
         ## use BERT Encoder
         else:
-            for layer_module in self.layer:
-                l_outputs = layer_module(lang_feats, lang_attention_mask, output_attentions=output_attentions)
+            for i, layer_module in enumerate(self.layer):
+                if use_cache:
+                    layer_past = past_key_values['lang'][i] if past_key_values is not None else None
+                    lang_feats, present = self.lang_layer_with_cache(layer_module, lang_feats, lang_attention_mask, layer_past)
+                    present_key_values['lang'] = present_key_values['lang'] + (present,)
+                    if output_hidden_states:
+                        language_hidden_states = language_hidden_states + (lang_feats,)
+                    continue
+                l_outputs = self.checkpointed_forward(
+                    'lang',
+                    lambda feats, layer_module=layer_module: layer_module(feats, lang_attention_mask, output_attentions=output_attentions),
+                    lang_feats,
+                )
                 lang_feats = l_outputs[0]
-                language_hidden_states = language_hidden_states + (lang_feats,)
+                if output_hidden_states:
+                    language_hidden_states = language_hidden_states + (lang_feats,)
                 if language_attentions is not None:
                     language_attentions = language_attentions + (l_outputs[1],)
 
+        # KG side is already encoded, so that only the language half of cross-modality layers is run
+        if kg_context is not None:
+            for i, layer_module in enumerate(self.x_layers):
+                x_outputs = layer_module.lang_only_forward(
+                    lang_feats,
+                    lang_attention_mask,
+                    kg_context.key_values[i],
+                    kg_context.padding_mask,
+                    output_attentions=output_attentions,
+                    past_key_value=past_key_values['cross'][i] if past_key_values is not None else None,
+                    use_cache=use_cache,
+                )
+                lang_feats = x_outputs[0]
+                if use_cache:
+                    present_key_values['cross'] = present_key_values['cross'] + (x_outputs[-1],)
+                if output_hidden_states:
+                    language_hidden_states = language_hidden_states + (lang_feats,)
+                if cross_encoder_attentions is not None:
+                    cross_encoder_attentions = {k:cross_encoder_attentions[k] + (x_outputs[1][k],) for k in cross_encoder_attentions}
+            kg_hidden_states = kg_context.hidden_states
+            kg_feats = kg_context.kg_output
+
         # Run relational layers
-        for layer_module in self.r_layers:
-            kg_outputs = layer_module(kg_feats, kg_attention_mask, output_attentions=output_attentions)
+        for layer_module in self.r_layers if kg_context is None else []:
+            kg_outputs = self.checkpointed_forward(
+                'kg',
+                lambda feats, layer_module=layer_module: layer_module(feats, kg_attention_mask, output_attentions=output_attentions),
+                kg_feats,
+            )
             kg_feats = kg_outputs[0]
-            kg_hidden_states = kg_hidden_states + (kg_feats,)
+            if output_hidden_states:
+                kg_hidden_states = kg_hidden_states + (kg_feats,)
             if kg_attentions is not None:
                 kg_attentions = kg_attentions + (kg_outputs[1],)
 
         # Run cross-modality layers
-        for layer_module in self.x_layers:
-            x_outputs = layer_module(
+        for i, layer_module in enumerate(self.x_layers if kg_context is None else []):
+            layer_past = past_key_values['cross'][i] if past_key_values is not None else None
+            x_outputs = self.checkpointed_forward(
+                'cross',
+                lambda l_feats, v_feats, layer_module=layer_module, layer_past=layer_past: layer_module(
+                    l_feats,
+                    lang_attention_mask,
+                    v_feats,
+                    kg_padding_mask,
+                    kg_padding_mask,
+                    output_attentions=output_attentions,
+                    past_key_value=layer_past,
+                    use_cache=use_cache,
+                ),
                 lang_feats,
-                lang_attention_mask,
                 kg_feats,
-                kg_padding_mask,
-                kg_padding_mask,
-                output_attentions=output_attentions,
             )
             lang_feats, kg_feats = x_outputs[:2]
-            kg_hidden_states = kg_hidden_states + (kg_feats,)
-            language_hidden_states = language_hidden_states + (lang_feats,)
+            if use_cache:
+                present_key_values['cross'] = present_key_values['cross'] + (x_outputs[-1],)
+            if output_hidden_states:
+                kg_hidden_states = kg_hidden_states + (kg_feats,)
+                language_hidden_states = language_hidden_states + (lang_feats,)
             if cross_encoder_attentions is not None:
                 cross_encoder_attentions = {k:cross_encoder_attentions[k] + (x_outputs[2][k],) for k in cross_encoder_attentions}
+        if not output_hidden_states:
+            language_hidden_states, kg_hidden_states = (lang_feats,), (kg_feats,)
         kg_encoder_outputs = (
             kg_hidden_states,
             kg_attentions if output_attentions else None,
@@ -762,6 +1287,7 @@ class GTXEncoder(nn.Module):
             kg_encoder_outputs,
             lang_encoder_outputs,
             cross_encoder_attentions if output_attentions else None,
+            present_key_values,
         )
 
 class GTXPooler(nn.Module):
@@ -947,6 +1473,13 @@ class GTXModel(GTXPreTrainedModel):
         self.encoder = GTXEncoder(config)
         self.pooler = GTXPooler(config)
 
+        # dense: additive (batch_size, seq_len, seq_len) masks / edge_list: attention on the allowed pairs only
+        self.kg_attention_layout = config.kg_attention_layout if 'kg_attention_layout' in vars(config).keys() else 'dense'
+        if self.kg_attention_layout not in ['dense', 'edge_list']:
+            raise NotImplementedError("not implemented yet, a such kind of KG attention layout:", self.kg_attention_layout)
+        # the KG side is only attended by GTXAttention, which also takes boolean masks (see ATTENTION_BACKENDS)
+        self.attention_backend = config.attention_backend if 'attention_backend' in vars(config).keys() else 'eager'
+
         self.init_weights()
 
     def get_lang_embeddings(self):
@@ -964,6 +1497,113 @@ class GTXModel(GTXPreTrainedModel):
         else:
             self.kg_embeddings.word_embeddings.weight.data = new_embeddings.data
 
+    def kg_mask_values(self, mask):
+        """ Boolean masks (True to attend) with the bool attention backend, otherwise additive (0 / -10000) masks """
+        if self.attention_backend == 'bool':
+            return mask.bool()
+        mask = mask.to(dtype=self.dtype)
+        return (1.0 - mask) * -10000.0
+
+    def get_extended_kg_masks(self, kg_attention_mask, kg_padding_mask):
+        if kg_attention_mask is not None and self.kg_attention_layout == 'edge_list':
+            if len(kg_attention_mask.shape) != 3:
+                raise ValueError("The edge_list layout of KG attention only supports batch_size X seq_len X seq_len mask")
+            # the relational layers only score the allowed pairs
+            extended_kg_attention_mask = GTXEdgeList(edge_index=kg_attention_mask.nonzero().t(),
+                                                     num_nodes=kg_attention_mask.size(-1))
+            # Process KG padding mask for cross attention
+            extended_kg_padding_mask = kg_padding_mask.unsqueeze(1).unsqueeze(2)
+            extended_kg_padding_mask = self.kg_mask_values(extended_kg_padding_mask)
+        elif kg_attention_mask is not None:
+            if len(kg_attention_mask.shape)==3:
+                # Process KG-side self attention mask
+                extended_kg_attention_mask = kg_attention_mask.unsqueeze(1)
+                extended_kg_attention_mask = self.kg_mask_values(extended_kg_attention_mask)
+                # Process KG padding mask for cross attention
+                extended_kg_padding_mask = kg_padding_mask.unsqueeze(1).unsqueeze(2)
+                extended_kg_padding_mask = self.kg_mask_values(extended_kg_padding_mask)
+
+            elif len(kg_attention_mask.shape)==4:
+                # Process KG-side self attention mask
+                extended_kg_attention_mask = kg_attention_mask
+                extended_kg_attention_mask = self.kg_mask_values(extended_kg_attention_mask)
+                # Process KG padding mask for cross attention
+                extended_kg_padding_mask = kg_padding_mask.unsqueeze(1).unsqueeze(2)
+                extended_kg_padding_mask = self.kg_mask_values(extended_kg_padding_mask)
+            else:
+                raise ValueError("Only supports seq_len X seq_len mask or batch_size X # head X seq_len X seq_len")
+        else:
+            # Process KG padding mask for cross attention
+            extended_kg_padding_mask = kg_padding_mask.unsqueeze(1).unsqueeze(2)
+            extended_kg_padding_mask = self.kg_mask_values(extended_kg_padding_mask)
+            extended_kg_attention_mask = extended_kg_padding_mask.clone().detach()
+        return extended_kg_attention_mask, extended_kg_padding_mask
+
+    def get_extended_lang_attention_mask(self, lang_attention_mask, lang_is_causal=False, query_length=None):
+        """
+        Additive language attention mask, broadcastable to (batch_size, num_heads, query_length, key_length).
+        With lang_is_causal, lang_attention_mask is the (batch_size, key_length) padding mask, and the causal
+        structure is added as a (query_length, key_length) bias shared over the batch, where the queries are the
+        last query_length positions (e.g. new positions over cached key/values).
+        """
+        # We create a 3D attention mask from a 2D tensor mask.
+        # Sizes are [batch_size, 1, 1, to_seq_length]
+        # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
+        # this attention mask is more simple than the triangular masking of causal attention
+        # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
+        if lang_attention_mask is not None:
+            if len(lang_attention_mask.shape)==2: # (batch_size, seq_length)
+                extended_lang_attention_mask = lang_attention_mask.unsqueeze(1).unsqueeze(2)
+            elif len(lang_attention_mask.shape)==3: # (batch_size, seq_length, seq_length)
+                extended_lang_attention_mask = lang_attention_mask.unsqueeze(1)
+            elif len(lang_attention_mask.shape)==4: # (batch_size, 1, seq_length, seq_length)
+                extended_lang_attention_mask = lang_attention_mask
+            else:
+                raise ValueError("Only supports (batch_size, seq_length) or (batch_size, seq_length, seq_length) or even full extended")    
+        else:
+            raise ValueError("there is no attention mask for langauge part")
+
+        # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
+        # masked positions, this operation will create a tensor which is 0.0 for
+        # positions we want to attend and -10000.0 for masked positions.
+        # Since we are adding it to the raw scores before the softmax, this is
+        # effectively the same as removing these entirely.
+        extended_lang_attention_mask = extended_lang_attention_mask.to(dtype=self.dtype)
+        extended_lang_attention_mask = (1.0 - extended_lang_attention_mask) * -10000.0
+
+        if lang_is_causal:
+            if len(lang_attention_mask.shape) != 2:
+                raise ValueError("Causal masking is built from a (batch_size, seq_length) padding mask")
+            key_length = lang_attention_mask.size(1)
+            query_length = query_length if query_length is not None else key_length
+            causal_mask = torch.ones(query_length, key_length, dtype=self.dtype, device=lang_attention_mask.device)
+            causal_mask = causal_mask.tril(key_length - query_length)
+            extended_lang_attention_mask = extended_lang_attention_mask + (1.0 - causal_mask) * -10000.0
+        return extended_lang_attention_mask
+
+    def encode_kg(
+        self,
+        kg_input_ids=None,
+        kg_inputs_embeds=None,
+        kg_attention_mask=None,
+        kg_padding_mask=None,
+        output_hidden_states=None,
+    ):
+        """ Encode the KG side once so that it can be reused as kg_context, see :class:`GTXKGContext` """
+        output_hidden_states = (
+            output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
+        )
+        if kg_input_ids is not None and kg_inputs_embeds is not None:
+            raise ValueError("You cannot specify both input_ids and inputs_embeds at the same time")
+        extended_kg_attention_mask, extended_kg_padding_mask = self.get_extended_kg_masks(kg_attention_mask, kg_padding_mask)
+        kg_embedding_output = self.kg_embeddings(kg_input_ids, None, kg_inputs_embeds)
+        return self.encoder.encode_kg(
+            kg_embedding_output,
+            extended_kg_attention_mask,
+            extended_kg_padding_mask,
+            output_hidden_states=output_hidden_states,
+        )
+
     #@add_start_docstrings_to_callable(LXMERT_INPUTS_DOCSTRING.format("batch_size, sequence_length"))
     @add_code_sample_docstrings(
         tokenizer_class=_TOKENIZER_FOR_DOC,
@@ -983,6 +1623,11 @@ class GTXModel(GTXPreTrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
+        past_key_values=None,
+        use_cache=False,
+        kg_context=None,
+        lang_position_ids=None,
+        lang_is_causal=False,
     ):
 
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
@@ -996,64 +1641,32 @@ class GTXModel(GTXPreTrainedModel):
         elif kg_input_ids is not None and kg_inputs_embeds is not None:
             raise ValueError("You cannot specify both input_ids and inputs_embeds at the same time")
 
-        # We create a 3D attention mask from a 2D tensor mask.
-        # Sizes are [batch_size, 1, 1, to_seq_length]
-        # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
-        # this attention mask is more simple than the triangular masking of causal attention
-        # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
-        if lang_attention_mask is not None:
-            if len(lang_attention_mask.shape)==2: # (batch_size, seq_length)
-                extended_lang_attention_mask = lang_attention_mask.unsqueeze(1).unsqueeze(2)
-            elif len(lang_attention_mask.shape)==3: # (batch_size, seq_length, seq_length)
-                extended_lang_attention_mask = lang_attention_mask.unsqueeze(1)
-            elif len(lang_attention_mask.shape)==4: # (batch_size, 1, seq_length, seq_length)
-                extended_lang_attention_mask = lang_attention_mask
-            else:
-                raise ValueError("Only supports (batch_size, seq_length) or (batch_size, seq_length, seq_length) or even full extended")    
-        else:
-            raise ValueError("there is no attention mask for langauge part")
-
-        # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
-        # masked positions, this operation will create a tensor which is 0.0 for
-        # positions we want to attend and -10000.0 for masked positions.
-        # Since we are adding it to the raw scores before the softmax, this is
-        # effectively the same as removing these entirely.
-        extended_lang_attention_mask = extended_lang_attention_mask.to(dtype=self.dtype)
-        extended_lang_attention_mask = (1.0 - extended_lang_attention_mask) * -10000.0
-
-        # Process the KG attention mask
-        if kg_attention_mask is not None:
-            if len(kg_attention_mask.shape)==3:
-                # Process KG-side self attention mask
-                extended_kg_attention_mask = kg_attention_mask.unsqueeze(1)
-                extended_kg_attention_mask = extended_kg_attention_mask.to(dtype=self.dtype)
-                extended_kg_attention_mask = (1.0 - extended_kg_attention_mask) * -10000.0
-                # Process KG padding mask for cross attention
-                extended_kg_padding_mask = kg_padding_mask.unsqueeze(1).unsqueeze(2)
-                extended_kg_padding_mask = extended_kg_padding_mask.to(dtype=self.dtype)
-                extended_kg_padding_mask = (1.0 - extended_kg_padding_mask) * -10000.0
+        # Process the language attention mask (causal masking is built here rather than in the data collator)
+        extended_lang_attention_mask = self.get_extended_lang_attention_mask(
+            lang_attention_mask,
+            lang_is_causal=lang_is_causal,
+            query_length=(lang_input_ids if lang_input_ids is not None else lang_inputs_embeds).size(1),
+        )
 
-            elif len(kg_attention_mask.shape)==4:
-                # Process KG-side self attention mask
-                extended_kg_attention_mask = kg_attention_mask
-                extended_kg_attention_mask = extended_kg_attention_mask.to(dtype=self.dtype)
-                extended_kg_attention_mask = (1.0 - extended_kg_attention_mask) * -10000.0
-                # Process KG padding mask for cross attention
-                extended_kg_padding_mask = kg_padding_mask.unsqueeze(1).unsqueeze(2)
-                extended_kg_padding_mask = extended_kg_padding_mask.to(dtype=self.dtype)
-                extended_kg_padding_mask = (1.0 - extended_kg_padding_mask) * -10000.0
-            else:
-                raise ValueError("Only supports seq_len X seq_len mask or batch_size X # head X seq_len X seq_len")
+        # Process the KG attention mask (the KG side is skipped if it is already encoded)
+        if kg_context is None:
+            extended_kg_attention_mask, extended_kg_padding_mask = self.get_extended_kg_masks(kg_attention_mask, kg_padding_mask)
         else:
-            # Process KG padding mask for cross attention
-            extended_kg_padding_mask = kg_padding_mask.unsqueeze(1).unsqueeze(2)
-            extended_kg_padding_mask = extended_kg_padding_mask.to(dtype=self.dtype)
-            extended_kg_padding_mask = (1.0 - extended_kg_padding_mask) * -10000.0
-            extended_kg_attention_mask = extended_kg_padding_mask.clone().detach()
+            extended_kg_attention_mask, extended_kg_padding_mask = None, kg_context.padding_mask
 
         # Positional Word Embeddings
-        lang_embedding_output = self.lang_embeddings(lang_input_ids, token_type_ids, lang_inputs_embeds)
-        kg_embedding_output = self.kg_embeddings(kg_input_ids, None, kg_inputs_embeds)
+        # (positions continue after the cached ones when decoding incrementally)
+        past_key_values_length = 0
+        if past_key_values is not None:
+            past_key_values_length = (past_key_values['lang'] + past_key_values['cross'])[0][0].size(2)
+        lang_embedding_output = self.lang_embeddings(
+            lang_input_ids,
+            token_type_ids,
+            lang_inputs_embeds,
+            past_key_values_length=past_key_values_length,
+            position_ids=lang_position_ids,
+        )
+        kg_embedding_output = self.kg_embeddings(kg_input_ids, None, kg_inputs_embeds) if kg_context is None else None
 
         # Run GTX encoder
         encoder_outputs = self.encoder(
@@ -1063,9 +1676,14 @@ class GTXModel(GTXPreTrainedModel):
             kg_attention_mask=extended_kg_attention_mask,
             kg_padding_mask=extended_kg_padding_mask,
             output_attentions=output_attentions,
+            past_key_values=past_key_values,
+            use_cache=use_cache,
+            kg_context=kg_context,
+            output_hidden_states=output_hidden_states,
         )
 
         kg_encoder_outputs, lang_encoder_outputs = encoder_outputs[:2]
+        present_key_values = encoder_outputs[3]
         kg_hidden_states = kg_encoder_outputs[0]
         language_hidden_states = lang_encoder_outputs[0]
 
@@ -1085,10 +1703,20 @@ class GTXModel(GTXPreTrainedModel):
         kg_output = kg_hidden_states[-1]
         lang_output = language_hidden_states[-1]
         #pooled_output = self.pooler(lang_output)
-        pooled_output = self.pooler(kg_output, lang_output)
+        if kg_output.size(0) != lang_output.size(0):
+            # beams share the KG context of their batch item
+            num_repeats = lang_output.size(0) // kg_output.size(0)
+            pooled_output = self.pooler(kg_output[:, :1].repeat_interleave(num_repeats, dim=0), lang_output)
+        else:
+            pooled_output = self.pooler(kg_output, lang_output)
 
         if not return_dict:
-            return (lang_output, kg_output, pooled_output) + hidden_states + all_attentions
+            return (
+                (lang_output, kg_output, pooled_output)
+                + hidden_states
+                + all_attentions
+                + ((present_key_values,) if use_cache else ())
+            )
 
         return GTXModelOutput(
             pooled_output=pooled_output,
@@ -1099,6 +1727,7 @@ class GTXModel(GTXPreTrainedModel):
             language_attentions=language_attentions if output_attentions else None,
             kg_attentions=kg_attentions if output_attentions else None,
             cross_encoder_attentions=cross_encoder_attentions if output_attentions else None,
+            past_key_values=present_key_values,
         )
 
 class GTXForKGTokPredAndMaskedLM(GTXPreTrainedModel):
@@ -1162,6 +1791,7 @@ class GTXForKGTokPredAndMaskedLM(GTXPreTrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=True,
+        lang_is_causal=False,
     ):
         r"""
         masked_lm_labels (``torch.LongTensor`` of shape ``(batch_size, sequence_length)``, `optional`):
@@ -1197,6 +1827,7 @@ class GTXForKGTokPredAndMaskedLM(GTXPreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            lang_is_causal=lang_is_causal,
         )
 
         lang_output, kg_output, cross_relationship_score = (
@@ -1204,8 +1835,22 @@ class GTXForKGTokPredAndMaskedLM(GTXPreTrainedModel):
             GTX_output.kg_output,
             GTX_output.pooled_output,
         )
-        lang_prediction_scores = self.lm_head(lang_output)
-        kg_prediction_scores = self.classifier(self.dropout(kg_output))
+        # In training, the heads only score the labeled (masked) positions, as the losses ignore the others;
+        # evaluation keeps the full logits over every position.
+        # With alignment, negative samples follow the positive ones and have no labels, so only the first rows count.
+        ignore_index = self.loss_fcts['ce'].ignore_index
+        if self.training and lm_label is not None:
+            lm_positions = lm_label.ne(ignore_index)
+            lang_prediction_scores = self.lm_head(lang_output[:lm_label.size(0)][lm_positions])
+        else:
+            lang_prediction_scores = self.lm_head(lang_output)
+        if self.training and kg_label is not None:
+            kg_positions = kg_label.ne(ignore_index)
+            if kg_label_mask is not None:
+                kg_positions = kg_positions & kg_label_mask.bool()
+            kg_prediction_scores = self.classifier(self.dropout(kg_output[:kg_label.size(0)][kg_positions]))
+        else:
+            kg_prediction_scores = self.classifier(self.dropout(kg_output))
 
         total_loss = (
             None
@@ -1213,7 +1858,11 @@ class GTXForKGTokPredAndMaskedLM(GTXPreTrainedModel):
             else torch.tensor(0.0, device=device)
         )
         loss_dict = dict()
-        if lm_label is not None:
+        if lm_label is not None and self.training:
+            masked_lm_loss = self.loss_fcts["ce"](lang_prediction_scores, lm_label[lm_positions])
+            total_loss += masked_lm_loss
+            loss_dict['lm_loss']=masked_lm_loss.mean().item()
+        elif lm_label is not None:
             _lm_label = lm_label.view(-1)
             positive_batch_size = _lm_label.size(0)
             masked_lm_loss = self.loss_fcts["ce"](
@@ -1222,7 +1871,11 @@ class GTXForKGTokPredAndMaskedLM(GTXPreTrainedModel):
             )
             total_loss += masked_lm_loss
             loss_dict['lm_loss']=masked_lm_loss.mean().item()
-        if kg_label is not None:
+        if kg_label is not None and self.training:
+            kg_loss = self.loss_fcts['ce'](kg_prediction_scores, kg_label[kg_positions])
+            total_loss += kg_loss
+            loss_dict['kg_loss']=kg_loss.mean().item()
+        elif kg_label is not None:
             # if self.num_kg_labels == 1:
             #     #  We are doing regression
             #     kg_intm_loss = self.loss_fcts['mse'](kg_prediction_scores.view(-1), kg_label.view(-1))
@@ -1246,14 +1899,16 @@ class GTXForKGTokPredAndMaskedLM(GTXPreTrainedModel):
             total_loss += cross_loss
             loss_dict['align_loss']=cross_loss.mean().item()
         if rc_indeces is not None:
-            rc_labels = list()
-            rc_inputs = list()
-            for idx, sample_rc_indeces in enumerate(rc_indeces):
-                for rc_idx in sample_rc_indeces:
-                    rc_inputs.append(torch.cat([kg_output[idx, rc_idx[0]],kg_output[idx, rc_idx[1]]],dim=-1))
-                    rc_labels.append(rc_idx[2])
-            rc_outputs = self.edge_classifier(torch.stack(rc_inputs,dim=0))
-            rc_loss = self.loss_fcts['ce'](rc_outputs,torch.tensor(rc_labels,dtype=torch.long, device=device))
+            # rc_indeces: (batch_size, max_num_triples, 3) of (head, tail, relation), padded with relation -100
+            # (only the positive samples have triples when negative samples are appended for alignment)
+            num_samples, hidden_size = rc_indeces.size(0), kg_output.size(-1)
+            rc_nodes = rc_indeces[:, :, :2].reshape(num_samples, -1)
+            rc_inputs = torch.gather(kg_output[:num_samples], 1, rc_nodes.unsqueeze(-1).expand(-1, -1, hidden_size))
+            rc_inputs = rc_inputs.view(num_samples, -1, 2 * hidden_size) # [head; tail] of each triple
+            rc_labels = rc_indeces[:, :, 2]
+            rc_positions = rc_labels.ne(ignore_index)
+            rc_outputs = self.edge_classifier(rc_inputs[rc_positions])
+            rc_loss = self.loss_fcts['ce'](rc_outputs, rc_labels[rc_positions])
             total_loss += rc_loss
             loss_dict['rc_loss']=rc_loss.mean().item()
             
@@ -1720,6 +2375,11 @@ class GTXForGeneration(GTXPreTrainedModel):
         clean_outputs=True,
         given_gt_length=False,
         search_beam_size=1,
+        length_penalty=1.0,
+        max_decode_length=None,
+        decode_type='autoregressive',
+        mask_predict_iterations=10,
+        lang_is_causal=True,
         ):
         
         device = lang_input_ids.device if lang_input_ids is not None else lang_inputs_embeds.device
@@ -1736,10 +2396,30 @@ class GTXForGeneration(GTXPreTrainedModel):
                 
         # num_db: dx,prx(2) / px(1)
         num_db = len(torch.bincount(token_type_ids.flatten()))
+        # decoding stops at the num_db-th [SEP]; the reference length is only used to cut outputs (given_gt_length)
         gt_length = torch.sum(lang_input_ids.not_equal(self.pad_token_id), axis=1)
         
+        # 0. Non-autoregressive decoding by iterative refinement
+        if decode_type == 'mask_predict':
+            if search_beam_size != 1:
+                raise ValueError("mask_predict decoding keeps a single hypothesis, set search_beam_size to 1")
+            output_ids = self.mask_predict(
+                lang_input_ids=lang_input_ids,
+                kg_input_ids=kg_input_ids,
+                kg_inputs_embeds=kg_inputs_embeds,
+                kg_attention_mask=kg_attention_mask,
+                kg_padding_mask=kg_padding_mask,
+                num_db=num_db,
+                given_lang_tokens=1,
+                max_decode_length=max_decode_length,
+                mask_predict_iterations=mask_predict_iterations,
+            )
+        
+        elif decode_type != 'autoregressive':
+            raise NotImplementedError("not implemented yet, a such kind of decoding:", decode_type)
+        
         # 1. Greedy decoding
-        if search_beam_size == 1:
+        elif search_beam_size == 1:
             output_ids = self.greedy_decode(
                 lang_input_ids=lang_input_ids,
                 kg_input_ids=kg_input_ids,
@@ -1755,6 +2435,7 @@ class GTXForGeneration(GTXPreTrainedModel):
                 num_db=num_db,
                 gt_length=gt_length,
                 given_lang_tokens=1,
+                max_decode_length=max_decode_length,
             )
             
         # 2. Beam Search Decoding    
@@ -1775,16 +2456,21 @@ class GTXForGeneration(GTXPreTrainedModel):
                 num_db=num_db,
                 gt_length=gt_length,
                 given_lang_tokens=1,
+                length_penalty=length_penalty,
+                max_decode_length=max_decode_length,
             )
                                                       
         if clean_outputs:
-            output_ids = self.clean_output_ids(output_ids=output_ids,
-                                               gt_length=gt_length,
-                                               num_sep_id=num_db,
-                                               given_gt_length=given_gt_length)
+            output_ids, output_lengths = self.clean_output_ids(output_ids=output_ids,
+                                                               gt_length=gt_length,
+                                                               num_sep_id=num_db,
+                                                               given_gt_length=given_gt_length)
+        else:
+            output_lengths = output_ids.new_full(output_ids.shape[:-1], output_ids.size(-1))
         
-        outputs = (output_ids, kg_input_ids, lang_input_ids) if perturb_type is None \
-            else (output_ids, org_kg_input_ids, lang_input_ids, kg_input_ids)
+        # output_ids are padded by [PAD], and output_lengths (always the last) tell where each one ends
+        outputs = (output_ids, kg_input_ids, lang_input_ids, output_lengths) if perturb_type is None \
+            else (output_ids, org_kg_input_ids, lang_input_ids, kg_input_ids, output_lengths)
         return outputs
     
     def greedy_decode(
@@ -1806,65 +2492,228 @@ class GTXForGeneration(GTXPreTrainedModel):
         num_db=1,
         gt_length=None,
         given_lang_tokens=1,
+        max_decode_length=None,
         ):
-        
+        """
+        Greedy decoding. Each sequence stops when it emits its num_db-th [SEP] (or at max_decode_length), and finished
+        sequences are removed from the working batch. With cached key/values, only [predicted token, [MASK]] are fed
+        at each step; the [MASK] slot is a query only, so its key/values are dropped from the cache afterwards.
+        Returns (batch_size, length) ids in the original order, padded by [PAD] after the end of each sequence.
+        """
         assert len(lang_input_ids.shape) == 2
-        batch_size, max_length = lang_input_ids.shape
-        
-        # set output_length for max_length within a batch
-        output_length = torch.max(gt_length).item()
-        assert output_length <= max_length
+        batch_size = lang_input_ids.size(0)
+        device = lang_input_ids.device
+        max_decode_length = max_decode_length or self.get_max_decode_length(lang_input_ids)
         
         # construct initial settings [[CLS], [MASK]]
-        output_ids = []
         curr_ids = lang_input_ids[:, :given_lang_tokens]
-        mask_ids = lang_input_ids.new(batch_size, 1).fill_(self.mask_token_id)
-        output_ids.append(curr_ids)
+        output_ids = lang_input_ids.new(batch_size, max_decode_length).fill_(self.pad_token_id)
+        output_ids[:, :given_lang_tokens] = curr_ids
+        
+        # encode the KG side only once, if it does not depend on the text
+        kg_context = self.encode_kg_context(kg_input_ids, kg_inputs_embeds, kg_attention_mask, kg_padding_mask)
+        use_cache = self.GTX.encoder.supports_cache
+        
+        # states of the sequences being decoded, where active holds their indices in the original batch
+        active = torch.arange(batch_size, device=device)
+        mask_ids = curr_ids.new(batch_size, 1).fill_(self.mask_token_id)
+        # token type of a generated position is the number of [SEP]s before it (dx: 0, prx: 1)
+        num_seps = curr_ids[:, 1:].eq(self.sep_token_id).sum(dim=1)
+        curr_token_type_ids = token_type_ids[:, :given_lang_tokens]
+        past_key_values = None
+        step_ids = torch.cat([curr_ids, mask_ids], dim=1)
+        step_token_type_ids = torch.cat([curr_token_type_ids, torch.clamp(num_seps, max=num_db-1).unsqueeze(1)], dim=1)
         
         next_pos = given_lang_tokens
-        while next_pos < output_length:
-            
-            curr_length = list(curr_ids.size())[1]
-            curr_ids = torch.cat([curr_ids, mask_ids], axis=1)
-            curr_attention_mask = lang_attention_mask[:, :curr_length+1, :curr_length+1]
-            curr_token_type_ids = token_type_ids[:, :curr_length+1]
-            assert curr_ids.shape[-1] == curr_attention_mask.shape[-1]
-            
-            # when dx, prx case, we should consider token_type_ids
-            if num_db == 2:
-                curr_token_type_ids = self.convert_token_type_ids(curr_ids, curr_token_type_ids)
+        while next_pos < max_decode_length:
             
+            past_length = next_pos + 1 - step_ids.size(1)
             GTX_output = self.GTX(
-                lang_input_ids=curr_ids,
+                lang_input_ids=step_ids,
                 kg_input_ids=kg_input_ids,
                 # lang_inputs_embeds=lang_inputs_embeds,
                 kg_inputs_embeds=kg_inputs_embeds,
-                lang_attention_mask=curr_attention_mask,
+                lang_attention_mask=step_ids.new_ones(step_ids.size(0), past_length + step_ids.size(1)),
+                lang_is_causal=True,
                 kg_attention_mask=kg_attention_mask,
                 kg_padding_mask=kg_padding_mask,
-                token_type_ids=curr_token_type_ids,
+                token_type_ids=step_token_type_ids,
                 output_attentions=output_attentions,
                 output_hidden_states=output_hidden_states,
-                return_dict=return_dict,
-            )
-            lang_output, _, _ = (
-                GTX_output.language_output,
-                GTX_output.kg_output,
-                GTX_output.pooled_output,
+                return_dict=True,
+                past_key_values=past_key_values,
+                use_cache=use_cache,
+                kg_context=kg_context,
             )
             
             # predict [MASK] by greedy infer.
-            last_hidden = lang_output[:, -1, :]
-            prediction_scores = self.lm_head(last_hidden)
+            prediction_scores = self.lm_head(GTX_output.language_output[:, -1, :])
             _, max_ids = torch.max(prediction_scores, dim=1)
-            output_ids.append(max_ids.unsqueeze(1))
+            output_ids[active, next_pos] = max_ids
             
-            # setup for next loop
-            curr_ids[:, curr_length] = max_ids
+            # setup for next loop: the predicted token takes the place of [MASK]
+            curr_ids = torch.cat([curr_ids, max_ids.unsqueeze(1)], dim=1)
+            curr_token_type_ids = torch.cat([curr_token_type_ids, torch.clamp(num_seps, max=num_db-1).unsqueeze(1)], dim=1)
+            num_seps = num_seps + max_ids.eq(self.sep_token_id).long()
+            if use_cache:
+                past_key_values = self.crop_past_key_values(GTX_output.past_key_values, next_pos)
             next_pos += 1
             
-        output_ids = torch.cat(output_ids, dim=1)
-        return output_ids
+            # a sequence is finished with its num_db-th [SEP], then removed from the working batch
+            unfinished = num_seps.lt(num_db)
+            if not unfinished.all():
+                if not unfinished.any():
+                    break
+                keep = unfinished.nonzero(as_tuple=False).squeeze(1)
+                active, curr_ids, curr_token_type_ids = active[keep], curr_ids[keep], curr_token_type_ids[keep]
+                num_seps, mask_ids = num_seps[keep], mask_ids[keep]
+                if use_cache:
+                    past_key_values = self.reorder_past_key_values(past_key_values, keep)
+                if kg_context is not None:
+                    kg_context = kg_context.index_select(keep)
+                else:
+                    select = lambda x: x.index_select(0, keep) if x is not None else None
+                    kg_input_ids, kg_inputs_embeds = select(kg_input_ids), select(kg_inputs_embeds)
+                    kg_attention_mask, kg_padding_mask = select(kg_attention_mask), select(kg_padding_mask)
+            
+            step_ids = torch.cat([curr_ids[:, -1:] if use_cache else curr_ids, mask_ids], dim=1)
+            step_token_type_ids = torch.cat(
+                [
+                    curr_token_type_ids[:, -1:] if use_cache else curr_token_type_ids,
+                    torch.clamp(num_seps, max=num_db-1).unsqueeze(1),
+                ],
+                dim=1,
+            )
+            
+        return output_ids[:, :next_pos]
+    
+    def mask_predict(
+        self,
+        lang_input_ids=None,
+        kg_input_ids=None,
+        kg_inputs_embeds=None,
+        kg_attention_mask=None,
+        kg_padding_mask=None,
+        num_db=1,
+        given_lang_tokens=1,
+        max_decode_length=None,
+        mask_predict_iterations=10,
+        ):
+        """
+        Non-autoregressive decoding by iterative refinement (Mask-Predict, Ghazvininejad et al., 2019).
+        1. Length: every position after the given tokens is [MASK], and the length ends at the num_db-th predicted [SEP].
+        2. All positions within the length are predicted in one pass.
+        3. The lowest-confidence tokens are re-masked and re-predicted, with linearly fewer [MASK]s at each iteration.
+        The text attends bidirectionally as in the masked-LM pretraining, so that it takes 1 + mask_predict_iterations
+        passes regardless of the length. Returns (batch_size, length) ids padded by [PAD].
+        """
+        batch_size = lang_input_ids.size(0)
+        device = lang_input_ids.device
+        max_decode_length = max_decode_length or self.get_max_decode_length(lang_input_ids)
+        positions = torch.arange(max_decode_length, device=device).unsqueeze(0)
+        fixed = positions.lt(given_lang_tokens).expand(batch_size, -1)
+        
+        # encode the KG side only once, if it does not depend on the text
+        kg_context = self.encode_kg_context(kg_input_ids, kg_inputs_embeds, kg_attention_mask, kg_padding_mask)
+        predict = lambda ids, attention_mask: self.predict_masked_tokens(
+            ids, attention_mask, num_db, kg_context, kg_input_ids, kg_inputs_embeds, kg_attention_mask, kg_padding_mask
+        )
+        
+        # 1. predict the length from a fully masked sequence
+        masked_ids = lang_input_ids.new(batch_size, max_decode_length).fill_(self.mask_token_id)
+        masked_ids[:, :given_lang_tokens] = lang_input_ids[:, :given_lang_tokens]
+        predicted_ids, _ = predict(masked_ids, torch.ones_like(masked_ids))
+        reached = (predicted_ids.eq(self.sep_token_id) & ~fixed).long().cumsum(dim=1).ge(num_db)
+        lengths = torch.clamp((~reached).sum(dim=1) + 1, max=max_decode_length)
+        length_mask = positions.lt(lengths.unsqueeze(1))
+        fillable = length_mask & ~fixed
+        
+        # 2. fill every position within the length; given tokens are never re-masked
+        masked_ids = masked_ids.masked_fill(~length_mask, self.pad_token_id)
+        predicted_ids, predicted_probs = predict(masked_ids, length_mask.long())
+        output_ids = torch.where(fillable, predicted_ids, masked_ids)
+        output_probs = predicted_probs.masked_fill(~fillable, float('inf'))
+        
+        # 3. re-mask and re-predict the lowest-confidence tokens
+        num_fillable = fillable.sum(dim=1).float()
+        for iteration in range(1, mask_predict_iterations):
+            num_masks = (num_fillable * (mask_predict_iterations - iteration) / mask_predict_iterations).long()
+            if num_masks.max().item() == 0:
+                break
+            ranks = output_probs.argsort(dim=1).argsort(dim=1)
+            remask = ranks.lt(num_masks.unsqueeze(1))
+            predicted_ids, predicted_probs = predict(output_ids.masked_fill(remask, self.mask_token_id), length_mask.long())
+            output_ids = torch.where(remask, predicted_ids, output_ids)
+            output_probs = torch.where(remask, predicted_probs, output_probs)
+        
+        return output_ids[:, :lengths.max().item()]
+    
+    def predict_masked_tokens(
+        self,
+        lang_input_ids,
+        lang_attention_mask,
+        num_db,
+        kg_context=None,
+        kg_input_ids=None,
+        kg_inputs_embeds=None,
+        kg_attention_mask=None,
+        kg_padding_mask=None,
+        chunk_size=128,
+        ):
+        """ Most probable token (other than [MASK] and [PAD]) and its probability at every position, in one pass """
+        token_type_ids = self.convert_token_type_ids(lang_input_ids, num_db)
+        GTX_output = self.GTX(
+            lang_input_ids=lang_input_ids,
+            kg_input_ids=kg_input_ids,
+            kg_inputs_embeds=kg_inputs_embeds,
+            lang_attention_mask=lang_attention_mask,
+            kg_attention_mask=kg_attention_mask,
+            kg_padding_mask=kg_padding_mask,
+            token_type_ids=token_type_ids,
+            return_dict=True,
+            kg_context=kg_context,
+        )
+        
+        # LM head over chunks of positions, not to keep (batch_size, length, vocab_size) logits at once
+        banned_ids = torch.tensor([self.mask_token_id, self.pad_token_id], device=lang_input_ids.device)
+        predicted_probs, predicted_ids = [], []
+        for start in range(0, lang_input_ids.size(1), chunk_size):
+            prediction_scores = self.lm_head(GTX_output.language_output[:, start:start+chunk_size])
+            prediction_scores = prediction_scores.index_fill(-1, banned_ids, float('-inf'))
+            max_probs, max_ids = F.softmax(prediction_scores, dim=-1).max(dim=-1)
+            predicted_probs.append(max_probs)
+            predicted_ids.append(max_ids)
+        return torch.cat(predicted_ids, dim=1), torch.cat(predicted_probs, dim=1)
+    
+    def get_max_decode_length(self, lang_input_ids):
+        """ Decoding is bounded by the language position embeddings (or by the input width without them) """
+        max_position_embeddings = self.config.max_position_embeddings['lang']
+        return max_position_embeddings if max_position_embeddings > 0 else lang_input_ids.size(1)
+    
+    def encode_kg_context(self, kg_input_ids, kg_inputs_embeds, kg_attention_mask, kg_padding_mask):
+        """ Encode the KG side once per batch when the KG side does not depend on the text, otherwise None """
+        if self.GTX.encoder.cross_att_type != 'unilm':
+            return None
+        return self.GTX.encode_kg(
+            kg_input_ids=kg_input_ids,
+            kg_inputs_embeds=kg_inputs_embeds,
+            kg_attention_mask=kg_attention_mask,
+            kg_padding_mask=kg_padding_mask,
+        )
+    
+    @staticmethod
+    def crop_past_key_values(past_key_values, length):
+        return {
+            k: tuple((layer_past[0][:, :, :length], layer_past[1][:, :, :length]) for layer_past in v)
+            for k, v in past_key_values.items()
+        }
+    
+    @staticmethod
+    def reorder_past_key_values(past_key_values, index):
+        return {
+            k: tuple((layer_past[0].index_select(0, index), layer_past[1].index_select(0, index)) for layer_past in v)
+            for k, v in past_key_values.items()
+        }
     
     def decode_for_ppl(
         self,
@@ -1887,6 +2736,8 @@ class GTXForGeneration(GTXPreTrainedModel):
         clean_outputs=True,
         given_gt_length=False,
         search_beam_size=1,
+        teacher_forcing=True,
+        **kwargs,
         ):
         
         total_ppl = 0.0
@@ -1894,6 +2745,10 @@ class GTXForGeneration(GTXPreTrainedModel):
         assert len(lang_input_ids.shape) == 2
         batch_size, max_length = lang_input_ids.shape
         
+        # (batch_size, seq_length) padding mask; causal masks of older collators share it on their diagonal
+        if len(lang_attention_mask.shape) == 3:
+            lang_attention_mask = torch.diagonal(lang_attention_mask, dim1=1, dim2=2)
+        
         # set output_length for max_length within a batch
         gt_length = torch.sum(lang_input_ids.not_equal(self.pad_token_id), axis=1)
         output_length = torch.max(gt_length).item()
@@ -1902,12 +2757,28 @@ class GTXForGeneration(GTXPreTrainedModel):
         # construct initial settings [[CLS], [MASK]]
         mask_ids = lang_input_ids.new(batch_size, 1).fill_(self.mask_token_id)
         
+        # encode the KG side only once, if it does not depend on the text
+        kg_context = self.encode_kg_context(kg_input_ids, kg_inputs_embeds, kg_attention_mask, kg_padding_mask)
+        
+        # score every position in one forward pass, when the language part only attends to the previous positions
+        if teacher_forcing and self.GTX.encoder.supports_cache and output_length > 1:
+            total_ppl = self.teacher_forced_nll(
+                lang_input_ids=lang_input_ids,
+                lang_attention_mask=lang_attention_mask,
+                token_type_ids=token_type_ids,
+                kg_context=kg_context,
+                gt_length=gt_length,
+                output_length=output_length,
+            )
+            total_ppl = torch.exp(total_ppl/gt_length)
+            return total_ppl.mean().item()
+        
         next_pos = 1
         while next_pos < output_length:
             
             curr_ids = torch.cat([lang_input_ids[:, :next_pos], mask_ids], axis=1)
             curr_length = list(curr_ids.size())[1]
-            curr_attention_mask = lang_attention_mask[:, :curr_length, :curr_length]
+            curr_attention_mask = lang_attention_mask[:, :curr_length]
             curr_token_type_ids = token_type_ids[:, :curr_length]
             
             assert curr_ids.shape[-1] == curr_attention_mask.shape[-1]
@@ -1924,6 +2795,8 @@ class GTXForGeneration(GTXPreTrainedModel):
                 output_attentions=output_attentions,
                 output_hidden_states=output_hidden_states,
                 return_dict=return_dict,
+                kg_context=kg_context,
+                lang_is_causal=True,
             )
             lang_output, _, _ = (
                 GTX_output.language_output,
@@ -1948,6 +2821,66 @@ class GTXForGeneration(GTXPreTrainedModel):
         total_ppl = torch.exp(total_ppl/gt_length)
         batch_mean_ppl = total_ppl.mean().item()
         return batch_mean_ppl
+    
+    def teacher_forced_nll(
+        self,
+        lang_input_ids,
+        lang_attention_mask,
+        token_type_ids,
+        kg_context,
+        gt_length,
+        output_length,
+        chunk_size=128,
+        ):
+        """
+        Sum of NLL of the ground-truth tokens at positions 1..output_length-1, in a single forward pass.
+        Same as running [x_0, ..., x_{t-1}, [MASK]] for every t: the ground-truth tokens x_0..x_{L-2} are followed by
+        [MASK]s at positions 1..L-1, where the [MASK] at position t attends to x_0..x_{t-1} and to itself only.
+        """
+        batch_size = lang_input_ids.size(0)
+        num_preds = output_length - 1
+        device = lang_input_ids.device
+        
+        mask_ids = lang_input_ids.new(batch_size, num_preds).fill_(self.mask_token_id)
+        shifted_ids = torch.cat([lang_input_ids[:, :num_preds], mask_ids], dim=1)
+        positions = torch.arange(num_preds, dtype=torch.long, device=device)
+        shifted_position_ids = torch.cat([positions, positions + 1]).unsqueeze(0).expand(batch_size, -1)
+        shifted_token_type_ids = torch.cat([token_type_ids[:, :num_preds], token_type_ids[:, 1:output_length]], dim=1)
+        
+        # (batch_size, 2 * num_preds, 2 * num_preds) mask: ground-truth tokens attend causally to themselves,
+        # and each [MASK] to the ground-truth tokens before it and to itself (padded positions attend to nothing)
+        padding_mask = lang_attention_mask[:, :output_length].float()
+        lower = torch.ones(num_preds, num_preds, dtype=padding_mask.dtype, device=device).tril()
+        real_rows = padding_mask[:, :num_preds, None] * lower
+        real_rows = torch.cat([real_rows, torch.zeros_like(real_rows)], dim=2)
+        mask_rows = torch.cat([padding_mask[:, 1:, None] * lower, torch.diag_embed(padding_mask[:, 1:])], dim=2)
+        shifted_attention_mask = torch.cat([real_rows, mask_rows], dim=1)
+        
+        GTX_output = self.GTX(
+            lang_input_ids=shifted_ids,
+            lang_attention_mask=shifted_attention_mask,
+            token_type_ids=shifted_token_type_ids,
+            return_dict=True,
+            kg_context=kg_context,
+            lang_position_ids=shifted_position_ids,
+        )
+        mask_hidden = GTX_output.language_output[:, num_preds:]
+        lm_label = lang_input_ids[:, 1:output_length]
+        
+        # LM head over chunks of positions, not to keep (batch_size, num_preds, vocab_size) logits at once
+        masked_lm_loss = []
+        for start in range(0, num_preds, chunk_size):
+            prediction_scores = self.lm_head(mask_hidden[:, start:start+chunk_size])
+            masked_lm_loss.append(self.ce_loss(
+                prediction_scores.reshape(-1, self.config.vocab_size['lang']),
+                lm_label[:, start:start+chunk_size].reshape(-1),
+            ).view(batch_size, -1))
+        masked_lm_loss = torch.cat(masked_lm_loss, dim=1)
+        
+        # the [MASK] at position t is counted as long as t+1 <= gt_length, as in the step-wise loop
+        curr_length = torch.arange(2, output_length+1, device=device)
+        loss_mask = curr_length.unsqueeze(0) <= gt_length.unsqueeze(1)
+        return (masked_lm_loss * loss_mask).sum(dim=1)
             
     def beam_search(
         self,
@@ -1969,170 +2902,166 @@ class GTXForGeneration(GTXPreTrainedModel):
         num_db=1,
         gt_length=None,
         given_lang_tokens=1,
+        length_penalty=1.0,
+        max_decode_length=None,
         ):
+        """
+        Batched beam search, where beams of a batch item are consecutive rows of (batch_size * search_beam_size).
+        A hypothesis is finished once it emits its num_db-th [SEP], and then it is extended by [PAD] at no cost.
+        Batch items whose hypotheses are all finished are removed from the working batch.
+        Returns (batch_size, search_beam_size, length) ids in the original order, where hypotheses are sorted by the
+        length-normalized score (sum of log-probabilities / length ** length_penalty).
+        """
+        batch_size = lang_input_ids.size(0)
+        K = search_beam_size
+        device = lang_input_ids.device
+        max_decode_length = max_decode_length or self.get_max_decode_length(lang_input_ids)
         
-        batch_size, max_length = lang_input_ids.shape
-
-        # find maximum output_length
-        output_length = torch.max(gt_length).item()
-        assert output_length <= max_length
+        # encode the KG side only once; beams share it by broadcasting instead of being expanded
+        kg_context = self.encode_kg_context(kg_input_ids, kg_inputs_embeds, kg_attention_mask, kg_padding_mask)
+        if kg_context is None:
+            expand = lambda x: x.repeat_interleave(K, dim=0) if x is not None else None
+            kg_input_ids, kg_inputs_embeds = expand(kg_input_ids), expand(kg_inputs_embeds)
+            kg_attention_mask, kg_padding_mask = expand(kg_attention_mask), expand(kg_padding_mask)
+        use_cache = self.GTX.encoder.supports_cache
         
-        # init settings
-        curr_ids = lang_input_ids[:, :1]
-        mask_ids = curr_ids.new(batch_size, 1).fill_(self.mask_token_id)
-        # output_ids = []
-        # output_ids.append(curr_ids)
-
-        next_pos = 1
-        K = search_beam_size
-
-        total_scores = []
-        beam_masks = []
-        step_ids = []
-        step_back_ptrs = []
-        # partial_seqs = []
-        # forbid_word_mask = None
-        # buf_matrix = None
-
-        while next_pos < output_length:
-            
-            # construct current inputs
-            curr_length = list(curr_ids.size())[1]
-            curr_ids = torch.cat([curr_ids, mask_ids], axis=1)    
-            curr_token_type_ids = token_type_ids[:, :curr_length+1]
-            curr_attention_mask = lang_attention_mask[:, :curr_length+1, :curr_length+1]
-            
-            # when dx,prx case, we should consider token_type_ids
-            if num_db == 2:
-                curr_token_type_ids = self.convert_token_type_ids(curr_ids, curr_token_type_ids)
+        # init settings: only the first beam is alive, so that the first step picks K distinct tokens
+        active_items = torch.arange(batch_size, device=device)
+        output_ids = lang_input_ids.new(batch_size, K, max_decode_length).fill_(self.pad_token_id)
+        beam_ids = lang_input_ids[:, :given_lang_tokens].repeat_interleave(K, dim=0)
+        beam_token_type_ids = token_type_ids[:, :given_lang_tokens].repeat_interleave(K, dim=0)
+        mask_ids = beam_ids.new(batch_size * K, 1).fill_(self.mask_token_id)
+        beam_scores = torch.zeros(batch_size, K, device=device)
+        beam_scores[:, 1:] = float('-inf')
+        beam_scores = beam_scores.view(-1)
+        beam_lengths = torch.zeros_like(beam_scores)
+        finished = torch.zeros(batch_size * K, dtype=torch.bool, device=device)
+        num_seps = beam_ids[:, 1:].eq(self.sep_token_id).sum(dim=1)
+        beam_range = torch.arange(K, device=device)
+        
+        past_key_values = None
+        step_ids = torch.cat([beam_ids, mask_ids], dim=1)
+        step_token_type_ids = torch.cat([beam_token_type_ids, torch.clamp(num_seps, max=num_db-1).unsqueeze(1)], dim=1)
+        
+        next_pos = given_lang_tokens
+        while next_pos < max_decode_length:
             
             # output for current inputs
+            num_items = active_items.size(0)
+            past_length = next_pos + 1 - step_ids.size(1)
             GTX_output = self.GTX(
-                lang_input_ids=curr_ids,
+                lang_input_ids=step_ids,
                 kg_input_ids=kg_input_ids,
-                lang_attention_mask=curr_attention_mask,
+                kg_inputs_embeds=kg_inputs_embeds,
+                lang_attention_mask=step_ids.new_ones(step_ids.size(0), past_length + step_ids.size(1)),
+                lang_is_causal=True,
+                kg_attention_mask=kg_attention_mask,
                 kg_padding_mask=kg_padding_mask,
-                token_type_ids=curr_token_type_ids,
+                token_type_ids=step_token_type_ids,
                 output_attentions=False,
                 output_hidden_states=False,
                 return_dict=True,
+                past_key_values=past_key_values,
+                use_cache=use_cache,
+                kg_context=kg_context,
             )
-            lang_output, _, _ = (
-                GTX_output.language_output,
-                GTX_output.kg_output,
-                GTX_output.pooled_output,
-            )
-            last_hidden = lang_output[:, -1, :]
-            prediction_scores = self.lm_head(last_hidden)
+            prediction_scores = self.lm_head(GTX_output.language_output[:, -1, :])
             log_scores = F.log_softmax(prediction_scores, dim=-1)
+            vocab_size = log_scores.size(-1)
             
-            # choose top-k logits and indices
-            kk_scores, kk_ids = torch.topk(log_scores, k=K) # (batch_size, beam_size) / (batch_size*beam_size, beam_size)
-            
-            def first_expand(x):
-                input_shape = list(x.size())
-                expanded_shape = input_shape[:1] + [1] + input_shape[1:]
-                x = torch.reshape(x, expanded_shape)
-                repeat_count = [1, K] + [1] * (len(input_shape) - 1)
-                x = x.repeat(*repeat_count)
-                x = torch.reshape(x, [input_shape[0] * K] + input_shape[1:])
-                return x
+            # finished hypotheses can only be extended by [PAD], which keeps their scores
+            pad_scores = torch.full_like(log_scores[:1], float('-inf'))
+            pad_scores[:, self.pad_token_id] = 0.0
+            log_scores = torch.where(finished.unsqueeze(1), pad_scores, log_scores)
             
-            def select_beam_items(x, ids):
-                id_shape = list(ids.size())
-                id_rank = len(id_shape)
-                assert len(id_shape) == 2
-                x_shape = list(x.size())
-                x = torch.reshape(x, [batch_size, K] + x_shape[1:])
-                x_rank = len(x_shape) + 1
-                assert x_rank >= 2
-                if id_rank < x_rank:
-                    ids = torch.reshape(
-                        ids, id_shape + [1] * (x_rank - id_rank))
-                    ids = ids.expand(id_shape + x_shape[1:])
-                y = torch.gather(x, 1, ids)
-                y = torch.reshape(y, x_shape)
-                return y
+            # choose top-k among (beam, token) candidates of each batch item
+            cand_scores = (beam_scores.unsqueeze(1) + log_scores).view(num_items, K * vocab_size)
+            k_scores, k_ids = torch.topk(cand_scores, k=K, dim=1)
+            back_ptrs = (torch.arange(num_items, device=device).unsqueeze(1) * K + torch.floor_divide(k_ids, vocab_size)).view(-1)
+            next_ids = torch.remainder(k_ids, vocab_size).view(-1)
             
-            if len(total_scores) == 0: # for the first time,
-                k_ids = torch.reshape(kk_ids, [batch_size, K])
-                back_ptrs = torch.zeros(batch_size, K, dtype=torch.long)
-                k_scores = torch.reshape(kk_scores, [batch_size, K])
-                print('start:', k_scores, k_ids)
-            else:
-                last_eos = torch.reshape(beam_masks[-1], [batch_size * K, 1])
-                last_seq_scores = torch.reshape(total_scores[-1], [batch_size * K, 1])
-                kk_scores += last_eos * (-10000.0) + last_seq_scores
-                kk_scores = torch.reshape(kk_scores, [batch_size, K * K])
-                k_scores, k_ids = torch.topk(kk_scores, k=K)
-                back_ptrs = torch.floor_divide(k_ids, K)
-                kk_ids = torch.reshape(kk_ids, [batch_size, K * K])
-                print('kk_ids', kk_ids[0])
-                print(k_ids[0])
-                k_ids = torch.gather(kk_ids, 1, k_ids)
-                print('gather 이후:', k_ids[0])
-                curr_ids = select_beam_items(curr_ids, back_ptrs.long())
-                print(curr_ids.shape)
-                for idx in range(curr_ids.shape[0]):
-                    print(self.tokenizer.decode(curr_ids[idx]))
-                print()
-                
-            step_back_ptrs.append(back_ptrs)
-            step_ids.append(k_ids)
-            beam_masks.append(torch.eq(k_ids, self.sep_token_id).float())
-            total_scores.append(k_scores)
-
-            if next_pos == 1: # for the first time,
-                curr_ids = first_expand(curr_ids)
-                kg_input_ids = first_expand(kg_input_ids)
-                token_type_ids = first_expand(token_type_ids)
-                lang_attention_mask = first_expand(lang_attention_mask)
-                kg_padding_mask = first_expand(kg_padding_mask)
-                mask_ids = first_expand(mask_ids)
-            
-            # fill out the [MASK]'s position with stretched ids
-            curr_ids[:, curr_length] = torch.reshape(k_ids, [batch_size * K])
+            # reorder hypotheses with their states
+            was_finished = finished.index_select(0, back_ptrs)
+            curr_type_ids = torch.clamp(num_seps.index_select(0, back_ptrs), max=num_db-1)
+            beam_ids = torch.cat([beam_ids.index_select(0, back_ptrs), next_ids.unsqueeze(1)], dim=1)
+            beam_token_type_ids = torch.cat([beam_token_type_ids.index_select(0, back_ptrs), curr_type_ids.unsqueeze(1)], dim=1)
+            beam_scores = k_scores.view(-1)
+            beam_lengths = beam_lengths.index_select(0, back_ptrs) + (~was_finished).float()
+            num_seps = num_seps.index_select(0, back_ptrs) + (next_ids.eq(self.sep_token_id) & ~was_finished).long()
+            finished = was_finished | num_seps.ge(num_db)
+            cache_index = back_ptrs
             next_pos += 1
             
-        output_ids = curr_ids.reshape(batch_size, K, -1)
-        
-        for idx in range(K):
-            print(f'batch_idx:0, beam_idx:{idx}:', self.tokenizer.decode(output_ids[0][idx], skip_special_tokens=True))
-            print()
-        print('original text:', self.tokenizer.decode(lang_input_ids[0], skip_special_tokens=True))
+            # batch items whose hypotheses are all finished are written out and removed from the working batch
+            item_done = finished.view(num_items, K).all(dim=1)
+            if item_done.any():
+                done = item_done.nonzero(as_tuple=False).squeeze(1)
+                rows = (done.unsqueeze(1) * K + beam_range).view(-1)
+                output_ids[active_items[done], :, :next_pos] = self.rank_hypotheses(
+                    beam_ids[rows], beam_scores[rows], beam_lengths[rows], K, length_penalty
+                )
+                if item_done.all():
+                    active_items = active_items[:0]
+                    break
+                keep = (~item_done).nonzero(as_tuple=False).squeeze(1)
+                rows = (keep.unsqueeze(1) * K + beam_range).view(-1)
+                active_items = active_items[keep]
+                beam_ids, beam_token_type_ids = beam_ids[rows], beam_token_type_ids[rows]
+                beam_scores, beam_lengths, num_seps, finished = beam_scores[rows], beam_lengths[rows], num_seps[rows], finished[rows]
+                mask_ids = mask_ids[rows]
+                cache_index = cache_index[rows]
+                if kg_context is not None:
+                    kg_context = kg_context.index_select(keep)
+                else:
+                    select = lambda x: x.index_select(0, rows) if x is not None else None
+                    kg_input_ids, kg_inputs_embeds = select(kg_input_ids), select(kg_inputs_embeds)
+                    kg_attention_mask, kg_padding_mask = select(kg_attention_mask), select(kg_padding_mask)
+            
+            # setup for next loop: only [predicted token, [MASK]] are fed with cached key/values of the rest
+            if use_cache:
+                past_key_values = self.crop_past_key_values(GTX_output.past_key_values, next_pos-1)
+                past_key_values = self.reorder_past_key_values(past_key_values, cache_index)
+                step_ids = torch.cat([beam_ids[:, -1:], mask_ids], dim=1)
+                step_token_type_ids = beam_token_type_ids[:, -1:]
+            else:
+                step_ids = torch.cat([beam_ids, mask_ids], dim=1)
+                step_token_type_ids = beam_token_type_ids
+            step_token_type_ids = torch.cat([step_token_type_ids, torch.clamp(num_seps, max=num_db-1).unsqueeze(1)], dim=1)
         
-        return output_ids
+        # hypotheses cut by max_decode_length
+        if active_items.size(0) > 0:
+            output_ids[active_items, :, :beam_ids.size(1)] = self.rank_hypotheses(
+                beam_ids, beam_scores, beam_lengths, K, length_penalty
+            )
+        return output_ids[:, :, :next_pos]
+    
+    @staticmethod
+    def rank_hypotheses(beam_ids, beam_scores, beam_lengths, num_beams, length_penalty=1.0):
+        """ Sort hypotheses of each batch item by their length-normalized scores, best first """
+        normalized_scores = beam_scores / beam_lengths.clamp(min=1.0) ** length_penalty
+        order = torch.argsort(normalized_scores.view(-1, num_beams), dim=1, descending=True)
+        beam_ids = beam_ids.view(-1, num_beams, beam_ids.size(-1))
+        return torch.gather(beam_ids, 1, order.unsqueeze(2).expand_as(beam_ids))
     
     def clean_output_ids(self, output_ids, gt_length, num_sep_id, given_gt_length):
-        c_output_ids = []
+        """
+        Cut outputs right before the num_sep_id-th [SEP] (and at the reference length, if given_gt_length).
+        output_ids: (batch_size, length) for greedy or (batch_size, num_beams, length) for beam search
+        Returns the ids padded by [PAD] after each length, and the lengths with the shape of output_ids[..., 0]
+        """
+        # number of [SEP]s up to each position, so that the num_sep_id-th [SEP] is the first position reaching it
+        num_seps = output_ids.eq(self.sep_token_id).long().cumsum(dim=-1)
+        output_lengths = num_seps.lt(num_sep_id).sum(dim=-1)
         if given_gt_length:
-            for i, o in enumerate(output_ids):
-                l_gt = gt_length[i]
-                sep_idx = o.eq(self.sep_token_id)
-                l_sep = torch.nonzero(sep_idx)[num_sep_id-1] if sep_idx.sum() >= num_sep_id else 512
-                c_output_ids.append(o[:min(l_gt, l_sep)])
-        else:
-            for o in output_ids:
-                if len(o.shape) == 1: # greedy
-                    sep_idx = o.eq(self.sep_token_id)
-                    l_sep = torch.nonzero(sep_idx)[num_sep_id-1] if sep_idx.sum() >= num_sep_id else 512
-                    c_output_ids.append(o[:min(512, l_sep)])
-                else: # beam search
-                    c_output_id = []
-                    for oo in o:
-                        sep_idx = oo.eq(self.sep_token_id)
-                        l_sep = torch.nonzero(sep_idx)[num_sep_id-1] if sep_idx.sum() >= num_sep_id else 512
-                        c_output_id.append(oo[:min(512, l_sep)])
-                    assert len(c_output_id) == o.shape[0] # beam size
-                    c_output_ids.append(c_output_id)
-        return c_output_ids
+            output_lengths = torch.min(output_lengths, gt_length.view((-1,) + (1,) * (output_ids.dim() - 2)))
+        positions = torch.arange(output_ids.size(-1), device=output_ids.device)
+        output_ids = output_ids.masked_fill(positions.ge(output_lengths.unsqueeze(-1)), self.pad_token_id)
+        return output_ids[..., :output_lengths.max().item()], output_lengths
     
-    def convert_token_type_ids(self, curr_ids, curr_token_type_ids):
-        for idx in range(len(curr_ids)):
-            if self.sep_token_id in curr_ids[idx][-2]:
-                first_sep_idx = torch.nonzero(curr_ids[idx].eq(self.sep_token_id))[0]
-                curr_token_type_ids[idx][first_sep_idx+1:] = 1        
-        return curr_token_type_ids
+    def convert_token_type_ids(self, curr_ids, num_db=2):
+        """ Segment of each position: the number of [SEP]s before it, up to num_db-1 """
+        is_sep = curr_ids.eq(self.sep_token_id).long()
+        return torch.clamp(is_sep.cumsum(dim=1) - is_sep, max=num_db-1)
         
     def perturb_graph_part(self,
                            kg_input_ids,
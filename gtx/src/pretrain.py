@@ -5,7 +5,7 @@ import os
 from dataclasses import dataclass, field
 from glob import glob
 from typing import Optional
-from torch.utils.data import ConcatDataset
+from torch.utils.data import ConcatDataset, IterableDataset
 
 # Own implementation
 from utils.parameters import parser
@@ -129,8 +129,10 @@ def main():
     train_dataset = get_dataset(data_args,
                     tokenizer=tokenizer,
                     token_type_vocab=config.token_type_vocab,
+                    seed=training_args.seed,
                     )
-    logger.info(train_dataset[0])
+    if not isinstance(train_dataset, IterableDataset):
+        logger.info(train_dataset[0])
     eval_dataset = get_dataset(data_args,
                                tokenizer=tokenizer,
                                token_type_vocab = config.token_type_vocab,
@@ -146,12 +148,14 @@ def main():
                                                         n_negatives = training_args.n_negatives,
                                                         edge_cls=training_args.edge_cls,
                                                         kg_special_token_ids=config.kg_special_token_ids,
-                                                        kg_size=config.vocab_size['kg'])
+                                                        kg_size=config.vocab_size['kg'],
+                                                        seed=training_args.seed)
         eval_data_collator = NodeClassification_DataCollator(tokenizer=tokenizer,
                                                 align=training_args.align,
                                                 edge_cls=training_args.edge_cls,
                                                 kg_special_token_ids=config.kg_special_token_ids,
-                                                kg_size=config.vocab_size['kg'])
+                                                kg_size=config.vocab_size['kg'],
+                                                seed=training_args.seed)
     elif config.task_mask_lm and not config.task_mask_kg:
         data_collator = UnimodalLM_DataCollator(tokenizer=tokenizer,
                                                         kg_special_token_ids=config.kg_special_token_ids,
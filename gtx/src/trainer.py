@@ -22,6 +22,7 @@ import math
 import os
 import re
 import shutil
+import sys
 import warnings
 from pathlib import Path
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
@@ -34,6 +35,8 @@ from packaging import version
 #from utils.compute_metrics import get_accuracy
 from sklearn.metrics import accuracy_score, f1_score, label_ranking_average_precision_score, top_k_accuracy_score
 from utils.metrics import precision_at_k, recall_at_k
+from utils.sampler import DistributedTokenBudgetBatchSampler, TokenBudgetBatchSampler, get_sample_lengths
+from utils.dataset import StreamingHeadOnlyDataset
 
 from torch import nn
 import torch.nn.functional as F
@@ -260,15 +263,43 @@ class Trainer:
                 else DistributedSampler(self.train_dataset)
             )
 
+    def _get_train_batch_sampler(self) -> Optional[TokenBudgetBatchSampler]:
+        if self.args.max_tokens_per_batch is None or not isinstance(self.train_dataset, collections.abc.Sized):
+            return None
+        if is_torch_tpu_available():
+            raise NotImplementedError("Token-budget batches are not supported on TPU")
+        logger.info("Computing sample lengths for the token-budget batch sampler")
+        lengths = get_sample_lengths(self.train_dataset, self.model.config.kg_special_token_ids['PAD'])
+        sampler_kwargs = dict(
+            max_tokens=self.args.max_tokens_per_batch,
+            max_batch_size=self.args.train_batch_size,
+            bucket_width=self.args.length_bucket_width,
+            seed=self.args.seed,
+        )
+        if self.args.local_rank == -1:
+            return TokenBudgetBatchSampler(lengths, **sampler_kwargs)
+        else:
+            return DistributedTokenBudgetBatchSampler(lengths, **sampler_kwargs)
+
     def get_train_dataloader(self) -> DataLoader:
         """
         Returns the training :class:`~torch.utils.data.DataLoader`.
-        Will use no sampler if :obj:`self.train_dataset` does not implement :obj:`__len__`, a random sampler (adapted
-        to distributed training if necessary) otherwise.
+        Will use no sampler if :obj:`self.train_dataset` does not implement :obj:`__len__`, a token-budget batch
+        sampler if :obj:`max_tokens_per_batch` is set, a random sampler (adapted to distributed training if necessary)
+        otherwise.
         Subclass and override this method if you want to inject some custom behavior.
         """
         if self.train_dataset is None:
             raise ValueError("Trainer: training requires a train_dataset.")
+        train_batch_sampler = self._get_train_batch_sampler()
+        if train_batch_sampler is not None:
+            return DataLoader(
+                self.train_dataset,
+                batch_sampler=train_batch_sampler,
+                collate_fn=self.data_collator,
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=True
+            )
         train_sampler = self._get_train_sampler()
         
         return DataLoader(
@@ -440,8 +471,10 @@ class Trainer:
                 num_train_epochs = math.ceil(self.args.num_train_epochs)
         else:
             # see __init__. max_steps is set when the dataset has no __len__
+            # StreamingHeadOnlyDataset is endless, so the first epoch runs until max_steps is reached and the step
+            # counter, which decides on gradient synchronization, is the same on every DDP rank
             max_steps = self.args.max_steps
-            num_train_epochs = 1
+            num_train_epochs = sys.maxsize
             num_update_steps_per_epoch = max_steps
 
         self.create_optimizer_and_scheduler(num_training_steps=max_steps)
@@ -464,12 +497,16 @@ class Trainer:
 
         # Distributed training (should be after apex fp16 initialization)
         if self.args.local_rank != -1:
+            gradient_checkpointing = getattr(model.config, "gradient_checkpointing", False)
+            if isinstance(gradient_checkpointing, dict):
+                # per-stack setting of GTXEncoder
+                gradient_checkpointing = any(gradient_checkpointing.values())
             model = torch.nn.parallel.DistributedDataParallel(
                 model,
                 device_ids=[self.args.local_rank],
                 output_device=self.args.local_rank,
                 find_unused_parameters=(
-                    not getattr(model.config, "gradient_checkpointing", False)
+                    not gradient_checkpointing
                     if isinstance(model, PreTrainedModel)
                     else True
                 ),
@@ -531,9 +568,14 @@ class Trainer:
 
         # self.control = self.callback_handler.on_train_begin(self.args, self.state, self.control)
 
+        FLAG_EarlyStop = False
         for epoch in tqdm(range(epochs_trained, num_train_epochs),desc='Epoch'):
             if isinstance(train_dataloader, DataLoader) and isinstance(train_dataloader.sampler, DistributedSampler):
                 train_dataloader.sampler.set_epoch(epoch)
+            elif isinstance(train_dataloader, DataLoader) and isinstance(train_dataloader.batch_sampler, TokenBudgetBatchSampler):
+                train_dataloader.batch_sampler.set_epoch(epoch)
+            elif isinstance(train_dataloader, DataLoader) and isinstance(train_dataloader.dataset, StreamingHeadOnlyDataset):
+                train_dataloader.dataset.set_epoch(epoch)
 
             if is_torch_tpu_available():
                 parallel_loader = pl.ParallelLoader(train_dataloader, [self.args.device]).per_device_loader(
@@ -600,7 +642,7 @@ class Trainer:
                     # self.control = self.callback_handler.on_step_end(self.args, self.state, self.control)
 
                     loss_dict, FLAG_EarlyStop = self.log_save_evaluate(loss_dict, model)
-                    if FLAG_EarlyStop:
+                    if FLAG_EarlyStop or self.state.global_step >= max_steps:
                         break
             if FLAG_EarlyStop:
                 break
@@ -619,6 +661,8 @@ class Trainer:
                     )
             # if self.control.should_training_stop:
             #     break
+            if self.state.global_step >= max_steps:
+                break
 
         if self.args.past_index and hasattr(self, "_past"):
             # Clean the state at the end of training
@@ -1120,7 +1164,15 @@ class Trainer:
         if preds:
             numpy_preds = list()
             for idx in range(len(preds[0])):
-                numpy_preds.append(np.concatenate([pred[idx] for pred in preds],axis=0))
+                batch_preds = [pred[idx] for pred in preds]
+                # batches differ in width with dynamic padding, so that they are padded to the widest one
+                if batch_preds[0].ndim > 1:
+                    max_width = max(p.shape[1] for p in batch_preds)
+                    batch_preds = [
+                        np.pad(p, [(0, 0), (0, max_width - p.shape[1])] + [(0, 0)] * (p.ndim - 2), constant_values=-100)
+                        for p in batch_preds
+                    ]
+                numpy_preds.append(np.concatenate(batch_preds,axis=0))
         else:
             numpy_preds = None
 
@@ -25,6 +25,92 @@ of Tensors.
 """
 DataCollator = NewType("DataCollator", Callable[[List[InputDataClass]], Dict[str, torch.Tensor]])
 
+def csr_to_dense_mask(csr_masks: List[Dict[str, torch.Tensor]]) -> torch.Tensor:
+    """
+    Rebuild the (batch_size, num_nodes, num_nodes) KG attention mask of a batch from CSR graph structures
+    ({'indptr': row pointers, 'indices': column indices}) with a single scatter.
+    """
+    num_nodes = max(len(m['indptr']) - 1 for m in csr_masks)
+    row_lengths = [m['indptr'][1:] - m['indptr'][:-1] for m in csr_masks]
+    batch_ids = torch.repeat_interleave(torch.arange(len(csr_masks)), torch.stack([r.sum() for r in row_lengths]))
+    row_ids = torch.cat([torch.repeat_interleave(torch.arange(len(r)), r) for r in row_lengths])
+    col_ids = torch.cat([m['indices'].long() for m in csr_masks])
+    dense_masks = torch.zeros(len(csr_masks), num_nodes, num_nodes)
+    dense_masks[batch_ids, row_ids, col_ids] = 1.0
+    return dense_masks
+
+def collate_kg_attention_mask(masks: list) -> torch.Tensor:
+    """
+    Batch the KG attention masks of the samples: CSR graph structures (see HeadOnlyDataset) are rebuilt as dense masks,
+    (num_nodes, num_nodes, num_relations) masks are stacked as (batch_size, num_relations, num_nodes, num_nodes).
+    """
+    if isinstance(masks[0], dict):
+        return csr_to_dense_mask(masks)
+    elif isinstance(masks[0], torch.Tensor):
+        if masks[0].dim() == 3:
+            return torch.stack(masks).permute(0,3,1,2)
+        return torch.stack(masks)
+    return torch.tensor(masks)
+
+# tensors of each stream which are padded along dimension 1 (sequence), see trim_batch_padding
+PADDED_KEYS = {
+    'lang': ('lang_input_ids', 'lang_attention_mask', 'token_type_ids'),
+    'kg': ('kg_input_ids', 'kg_attention_mask', 'kg_padding_mask', 'kg_label', 'kg_label_mask'),
+}
+
+def trim_batch_padding(
+    batch: Dict[str, torch.Tensor], lang_pad_token_id: int, kg_pad_token_id: int, kg_keys: Tuple[str, ...] = ()
+) -> Dict[str, torch.Tensor]:
+    """
+    Dynamic padding: trim the (right-padded) text and KG tensors of a batch to the longest real sequence of each stream.
+    The tensors of PADDED_KEYS (and the given kg_keys) are trimmed along their sequence dimension, which is dimension 1,
+    or the last two dimensions for (batch_size, [num_relations,] length, length) attention masks. Others are kept.
+    """
+    for prefix, pad_token_id, extra_keys in [('lang', lang_pad_token_id, ()), ('kg', kg_pad_token_id, kg_keys)]:
+        input_ids = batch.get(f'{prefix}_input_ids')
+        if not isinstance(input_ids, torch.Tensor) or input_ids.dim() != 2:
+            continue
+        real_positions = input_ids.ne(pad_token_id).any(dim=0).nonzero()
+        length = real_positions.max().item() + 1 if len(real_positions) > 0 else 1
+        if length == input_ids.size(1):
+            continue
+        for k in PADDED_KEYS[prefix] + tuple(extra_keys):
+            v = batch.get(k)
+            if not isinstance(v, torch.Tensor):
+                continue
+            if k.endswith('attention_mask') and v.dim() >= 3:
+                v = v.narrow(-2, 0, length).narrow(-1, 0, length)
+            else:
+                v = v.narrow(1, 0, length)
+            batch[k] = v.contiguous()
+    return batch
+
+def get_special_tokens_table(tokenizer: PreTrainedTokenizerBase) -> torch.Tensor:
+    """
+    Boolean table over the vocab (with added tokens), True for special tokens, as given by get_special_tokens_mask.
+    Indexing it with a batch of ids gives the special tokens mask without a per-token pass.
+    """
+    vocab_ids = list(range(len(tokenizer)))
+    return torch.tensor(tokenizer.get_special_tokens_mask(vocab_ids, already_has_special_tokens=True), dtype=torch.bool)
+
+# generators of this process, kept outside of the collators so that collators stay picklable for DataLoader workers
+_worker_generators = dict()
+
+def get_worker_generator(seed: Optional[int]) -> Optional[torch.Generator]:
+    """
+    Random generator of the current DataLoader worker (or of the main process), seeded with seed + worker id, so that
+    workers draw different but reproducible masks. None if no seed is given.
+    """
+    if seed is None:
+        return None
+    worker_info = torch.utils.data.get_worker_info()
+    worker_id = worker_info.id if worker_info is not None else -1
+    if (seed, worker_id) not in _worker_generators:
+        generator = torch.Generator()
+        generator.manual_seed(seed + worker_id + 1)
+        _worker_generators[(seed, worker_id)] = generator
+    return _worker_generators[(seed, worker_id)]
+
 @dataclass
 class NodeClassification_DataCollator:
     """
@@ -42,18 +128,26 @@ class NodeClassification_DataCollator:
     mlm_probability: float = 0.15
     contrastive: bool = False
     prediction: bool = False
+    dynamic_padding: bool = True
+    seed: Optional[int] = None
+
+    def __post_init__(self):
+        self.special_tokens_table = get_special_tokens_table(self.tokenizer)
 
     def __call__(self,features: List[InputDataClass]) -> Dict[str, torch.Tensor]:
         if not isinstance(features[0], (dict, BatchEncoding)):
             features = [vars(f) for f in features]
         batch = self._tensorize_batch(features)
+        if self.dynamic_padding:
+            batch = trim_batch_padding(batch, self.tokenizer.pad_token_id, self.kg_special_token_ids['PAD'])
 
         if not self.prediction:
             # Construct batch for Masked LM
-            masked_texts, lm_label = self.mask_tokens(batch['lang_input_ids'])
+            generator = get_worker_generator(self.seed)
+            masked_texts, lm_label = self.mask_tokens(batch['lang_input_ids'], generator=generator)
             # Construct batch for Masekd LP
             if not self.contrastive:
-                masked_subs, kg_label_mask, kg_padding_mask = self.mask_kg(batch['kg_input_ids'], batch['kg_label_mask'])
+                masked_subs, kg_label_mask, kg_padding_mask = self.mask_kg(batch['kg_input_ids'], batch['kg_label_mask'], generator=generator)
                 batch['kg_input_ids'] = masked_subs
                 batch['kg_label_mask'] = kg_label_mask
                 batch['kg_padding_mask'] = kg_padding_mask
@@ -83,17 +177,11 @@ class NodeClassification_DataCollator:
         for k, v in first.items():
             if 'rc' in k:
                 if self.edge_cls:
-                    batch[k] = [f[k] for f in features]
+                    batch[k] = self.pad_rc_indeces([f[k] for f in features])
                 continue
             if v is not None:
                 if (k == "kg_attention_mask") and not isinstance(v, str):
-                    if isinstance(v, torch.Tensor):
-                        if (len(v.shape) == 3):
-                            batch[k] = torch.stack([f[k] for f in features]).permute(0,3,1,2)
-                        else:
-                            batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
+                    batch[k] = collate_kg_attention_mask([f[k] for f in features])
                 elif not isinstance(v, str):
                     if isinstance(v, torch.Tensor):
                         batch[k] = torch.stack([f[k] for f in features])
@@ -102,6 +190,18 @@ class NodeClassification_DataCollator:
 
         return batch
 
+    def pad_rc_indeces(self, rc_indeces: List[List[List[int]]]) -> torch.Tensor:
+        """
+        Pad (head, tail, relation) triples of each sample into a (batch_size, max_num_triples, 3) tensor.
+        Padded triples point to the first node with the relation label -100, which is ignored by the loss.
+        """
+        rc_indeces = [torch.as_tensor(sample_rc_indeces, dtype=torch.long).view(-1, 3) for sample_rc_indeces in rc_indeces]
+        padded_rc_indeces = torch.zeros(len(rc_indeces), max(len(r) for r in rc_indeces), 3, dtype=torch.long)
+        padded_rc_indeces[:, :, 2] = -100
+        for idx, sample_rc_indeces in enumerate(rc_indeces):
+            padded_rc_indeces[idx, :len(sample_rc_indeces)] = sample_rc_indeces
+        return padded_rc_indeces
+
     def negative_sampling(self,batch, batch_size) -> Dict[str, torch.Tensor]:
         for k, v in batch.items():
             if v is not None:
@@ -117,7 +217,7 @@ class NodeClassification_DataCollator:
                                              torch.zeros(batch_size*self.n_negatives, dtype=torch.long)],dim=0)
         return batch
 
-    def mask_tokens(self, inputs: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    def mask_tokens(self, inputs: torch.Tensor, generator: Optional[torch.Generator] = None) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
         """
@@ -130,31 +230,30 @@ class NodeClassification_DataCollator:
         labels = inputs.clone()
         # We sample a few tokens in each sequence for masked-LM training (with probability args.mlm_probability defaults to 0.15 in Bert/RoBERTa)
         probability_matrix = torch.full(labels.shape, self.mlm_probability)
-        special_tokens_mask = [
-            self.tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in labels.tolist()
-        ]
-        probability_matrix.masked_fill_(torch.tensor(special_tokens_mask, dtype=torch.bool), value=0.0)
+        special_tokens_mask = self.special_tokens_table[labels]
+        probability_matrix.masked_fill_(special_tokens_mask, value=0.0)
         if self.tokenizer._pad_token is not None:
             padding_mask = labels.eq(self.tokenizer.pad_token_id)
             probability_matrix.masked_fill_(padding_mask, value=0.0)
-        masked_indices = torch.bernoulli(probability_matrix).bool()
+        masked_indices = torch.bernoulli(probability_matrix, generator=generator).bool()
         labels[~masked_indices] = -100  # We only compute loss on masked tokens
 
         # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-        indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8)).bool() & masked_indices
+        indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8), generator=generator).bool() & masked_indices
         inputs[indices_replaced] = self.tokenizer.convert_tokens_to_ids(self.tokenizer.mask_token)
 
         # 10% of the time, we replace masked input tokens with random word
-        indices_random = torch.bernoulli(torch.full(labels.shape, 0.5)).bool() & masked_indices & ~indices_replaced
-        random_words = torch.randint(len(self.tokenizer), labels.shape, dtype=torch.long)
+        indices_random = torch.bernoulli(torch.full(labels.shape, 0.5), generator=generator).bool() & masked_indices & ~indices_replaced
+        random_words = torch.randint(len(self.tokenizer), labels.shape, dtype=torch.long, generator=generator)
         inputs[indices_random] = random_words[indices_random]
 
         # The rest of the time (10% of the time) we keep the masked input tokens unchanged
         return inputs, labels
 
-    def mask_kg(self, inputs: torch.Tensor, entity_mask = None) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    def mask_kg(self, inputs: torch.Tensor, entity_mask = None, generator: Optional[torch.Generator] = None) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """
         Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
+        Random draws use the given generator (the global one if None).
         """
 
         if self.kg_special_token_ids['MASK'] is None:
@@ -167,15 +266,15 @@ class NodeClassification_DataCollator:
         if entity_mask is not None:
             probability_matrix.masked_fill_(ignore_masking, value=0.0)
         padding_mask = ~inputs.eq(self.kg_special_token_ids['PAD'])
-        masked_indices = torch.bernoulli(probability_matrix).bool()
+        masked_indices = torch.bernoulli(probability_matrix, generator=generator).bool()
 
         # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-        indices_replaced = torch.bernoulli(torch.full(inputs.shape, 0.8)).bool() & masked_indices
+        indices_replaced = torch.bernoulli(torch.full(inputs.shape, 0.8), generator=generator).bool() & masked_indices
         inputs[indices_replaced] = self.kg_special_token_ids['MASK']
 
         # 10% of the time, we replace masked input tokens with random word
-        indices_random = torch.bernoulli(torch.full(inputs.shape, 0.5)).bool() & masked_indices & ~indices_replaced
-        random_nodes = torch.randint(len(self.kg_special_token_ids),self.kg_size, inputs.shape, dtype=torch.long)
+        indices_random = torch.bernoulli(torch.full(inputs.shape, 0.5), generator=generator).bool() & masked_indices & ~indices_replaced
+        random_nodes = torch.randint(len(self.kg_special_token_ids),self.kg_size, inputs.shape, dtype=torch.long, generator=generator)
         inputs[indices_random] = random_nodes[indices_random]
 
         # The rest of the time (10% of the time) we keep the masked input tokens unchanged
@@ -198,11 +297,14 @@ class NegativeSampling_DataCollator:
     kg_special_token_ids: dict
     n_negatives: int = 1
     prediction: bool = False
+    dynamic_padding: bool = True
 
     def __call__(self,features: List[InputDataClass]) -> Dict[str, torch.Tensor]:
         if not isinstance(features[0], (dict, BatchEncoding)):
             features = [vars(f) for f in features]
         batch = self._tensorize_batch(features)
+        if self.dynamic_padding:
+            batch = trim_batch_padding(batch, self.tokenizer.pad_token_id, self.kg_special_token_ids['PAD'])
         batch_size = len(features)
 
         if not self.prediction:
@@ -231,13 +333,7 @@ class NegativeSampling_DataCollator:
                 continue
             if (v is not None) and (not isinstance(v, str)):
                 if (k == "kg_attention_mask"):
-                    if isinstance(v, torch.Tensor):
-                        if (len(v.shape) == 3):
-                            batch[k] = torch.stack([f[k] for f in features]).permute(0,3,1,2)
-                        else:
-                            batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
+                    batch[k] = collate_kg_attention_mask([f[k] for f in features])
                 else:
                     if isinstance(v, torch.Tensor):
                         batch[k] = torch.stack([f[k] for f in features])
@@ -269,19 +365,26 @@ class UniLM_DataCollator:
     mlm: bool = True
     mlm_probability: float = 0.15
     prediction: bool = False
+    dynamic_padding: bool = True
+    seed: Optional[int] = None
+
+    def __post_init__(self):
+        self.special_tokens_table = get_special_tokens_table(self.tokenizer)
 
     def __call__(self,features: List[InputDataClass]) -> Dict[str, torch.Tensor]:
         if not isinstance(features[0], (dict, BatchEncoding)):
             features = [vars(f) for f in features]
         batch = self._tensorize_batch(features)
+        if self.dynamic_padding:
+            batch = trim_batch_padding(batch, self.tokenizer.pad_token_id, self.kg_special_token_ids['PAD'])
 
         if not self.prediction:
             # Text Part
-            masked_texts, lm_label = self.mask_tokens_with_sep(batch['lang_input_ids'])
-            casual_mask = self.make_lang_attention_mask(batch['lang_attention_mask'])
+            masked_texts, lm_label = self.mask_tokens_with_sep(batch['lang_input_ids'], generator=get_worker_generator(self.seed))
             batch['lang_input_ids'] = masked_texts
             batch['lm_label'] = lm_label
-            batch['lang_attention_mask'] = casual_mask
+            # keep the (batch_size, seq_length) padding mask, the model builds the causal mask on its device
+            batch['lang_is_causal'] = True
                     
             # Graph Part
             _, kg_label_mask, kg_padding_mask = self.make_kg_padding_mask(batch['kg_input_ids']) # only need padding_mask
@@ -300,8 +403,7 @@ class UniLM_DataCollator:
             batch['kg_input_ids'] = batch['kg_input_ids']
             batch['kg_label'] = None
             
-            casual_mask = self.make_lang_attention_mask(batch['lang_attention_mask'])
-            batch['lang_attention_mask'] = casual_mask
+            batch['lang_is_causal'] = True
             _, kg_label_mask, kg_padding_mask = self.make_kg_padding_mask(batch['kg_input_ids']) # only need padding_mask
             batch['kg_padding_mask'] = kg_padding_mask
 
@@ -321,13 +423,7 @@ class UniLM_DataCollator:
                 continue
             if v is not None:
                 if (k == "kg_attention_mask") and not isinstance(v, str):
-                    if isinstance(v, torch.Tensor):
-                        if (len(v.shape) == 3):
-                            batch[k] = torch.stack([f[k] for f in features]).permute(0,3,1,2)
-                        else:
-                            batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
+                    batch[k] = collate_kg_attention_mask([f[k] for f in features])
                 elif not isinstance(v, str):
                     if isinstance(v, torch.Tensor):
                         batch[k] = torch.stack([f[k] for f in features])
@@ -336,7 +432,12 @@ class UniLM_DataCollator:
 
         return batch
 
-    def mask_tokens_with_sep(self, inputs: torch.Tensor, special_tokens_mask: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+    def mask_tokens_with_sep(
+        self,
+        inputs: torch.Tensor,
+        special_tokens_mask: Optional[torch.Tensor] = None,
+        generator: Optional[torch.Generator] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
         """
@@ -350,10 +451,7 @@ class UniLM_DataCollator:
         # We sample a few tokens in each sequence for masked-LM training (with probability args.mlm_probability defaults to 0.15 in Bert/RoBERTa)
         probability_matrix = torch.full(labels.shape, self.mlm_probability)
         if special_tokens_mask is None:
-            special_tokens_mask = [
-                self.tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in labels.tolist()
-            ]
-            special_tokens_mask = torch.tensor(special_tokens_mask, dtype=torch.bool)
+            special_tokens_mask = self.special_tokens_table[labels]
         else:
             special_tokens_mask = special_tokens_mask.bool()
 
@@ -366,17 +464,17 @@ class UniLM_DataCollator:
         if self.tokenizer._sep_token is not None:
             sep_mask = labels.eq(self.tokenizer.sep_token_id)
             probability_matrix.masked_fill_(sep_mask, value=0.5) 
-        masked_indices = torch.bernoulli(probability_matrix).bool()
+        masked_indices = torch.bernoulli(probability_matrix, generator=generator).bool()
 
         labels[~masked_indices] = -100  # We only compute loss on masked tokens
 
         # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-        indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8)).bool() & masked_indices
+        indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8), generator=generator).bool() & masked_indices
         inputs[indices_replaced] = self.tokenizer.convert_tokens_to_ids(self.tokenizer.mask_token)
 
         # 10% of the time, we replace masked input tokens with random word
-        indices_random = torch.bernoulli(torch.full(labels.shape, 0.5)).bool() & masked_indices & ~indices_replaced
-        random_words = torch.randint(len(self.tokenizer), labels.shape, dtype=torch.long)
+        indices_random = torch.bernoulli(torch.full(labels.shape, 0.5), generator=generator).bool() & masked_indices & ~indices_replaced
+        random_words = torch.randint(len(self.tokenizer), labels.shape, dtype=torch.long, generator=generator)
         inputs[indices_random] = random_words[indices_random]
 
         # The rest of the time (10% of the time) we keep the masked input tokens unchanged
@@ -392,13 +490,6 @@ class UniLM_DataCollator:
         
         return inputs, masked_indices, padding_mask.float()
 
-    def make_lang_attention_mask(self, attention_mask: torch.Tensor) -> torch.Tensor:
-        batch_size, seq_length = attention_mask.shape
-        seq_ids = torch.arange(seq_length)
-        causal_mask = seq_ids[None, None, :].repeat(batch_size, seq_length, 1) <= seq_ids[None, :, None]
-        causal_mask = attention_mask.unsqueeze(2) * causal_mask
-        return causal_mask
-
     def _assert_padding(self, batch):
         '''
         assert for grpah part
@@ -435,11 +526,14 @@ class AdmLvlPred_DataCollator:
     kg_special_token_ids: dict
     num_kg_labels: int
     prediction: bool = False
+    dynamic_padding: bool = True
 
     def __call__(self,features: List[InputDataClass]) -> Dict[str, torch.Tensor]:
         if not isinstance(features[0], (dict, BatchEncoding)):
             features = [vars(f) for f in features]
         batch = self._tensorize_batch(features)
+        if self.dynamic_padding:
+            batch = trim_batch_padding(batch, self.tokenizer.pad_token_id, self.kg_special_token_ids['PAD'])
         batch_size = len(features)
 
         # else:
@@ -458,16 +552,10 @@ class AdmLvlPred_DataCollator:
         for k, v in first.items():
             if (v is not None) and (not isinstance(v, str)):
                 if (k == 'label'):
-                    batch[k] = torch.stack([torch.zeros(self.num_kg_labels).index_fill_(0,torch.LongTensor(f[k]),1) for f in features])
+                    batch[k] = torch.stack([torch.zeros(self.num_kg_labels).index_fill_(0,torch.as_tensor(f[k],dtype=torch.long),1) for f in features])
                     continue
                 if (k == "kg_attention_mask"):
-                    if isinstance(v, torch.Tensor):
-                        if (len(v.shape) == 3):
-                            batch[k] = torch.stack([f[k] for f in features]).permute(0,3,1,2)
-                        else:
-                            batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
+                    batch[k] = collate_kg_attention_mask([f[k] for f in features])
                 else:
                     if isinstance(v, torch.Tensor):
                         batch[k] = torch.stack([f[k] for f in features])
@@ -493,11 +581,14 @@ class ErrorDetection_DataCollator:
     task: str
     corruption_probability: float = 0.1
     prediction: bool = False
+    dynamic_padding: bool = True
 
     def __call__(self,features: List[InputDataClass]) -> Dict[str, torch.Tensor]:
         if not isinstance(features[0], (dict, BatchEncoding)):
             features = [vars(f) for f in features]
         batch = self._tensorize_batch(features)
+        if self.dynamic_padding:
+            batch = trim_batch_padding(batch, self.tokenizer.pad_token_id, self.kg_special_token_ids['PAD'], kg_keys=('label',))
         if 'graph' in self.task:
             batch = self.kg_corruption(batch)
         elif 'text' in self.task:
@@ -521,13 +612,7 @@ class ErrorDetection_DataCollator:
                 continue
             if (v is not None) and not isinstance(v,str):
                 if k == "kg_attention_mask":
-                    if isinstance(v, torch.Tensor):
-                        if (len(v.shape) == 3):
-                            batch[k] = torch.stack([f[k] for f in features]).permute(0,3,1,2)
-                        else:
-                            batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
+                    batch[k] = collate_kg_attention_mask([f[k] for f in features])
                 else:
                     if isinstance(v, torch.Tensor):
                         batch[k] = torch.stack([f[k] for f in features])
@@ -661,11 +746,14 @@ class Evaluation_DataCollator:
     tokenizer: PreTrainedTokenizerBase
     task : str
     kg_special_token_ids: dict
+    dynamic_padding: bool = True
 
     def __call__(self,features: List[InputDataClass]) -> Dict[str, torch.Tensor]:
         if not isinstance(features[0], (dict, BatchEncoding)):
             features = [vars(f) for f in features]
         batch = self._tensorize_batch(features)
+        if self.dynamic_padding:
+            batch = trim_batch_padding(batch, self.tokenizer.pad_token_id, self.kg_special_token_ids['PAD'])
         batch_size = len(features)
 
         return batch
@@ -683,13 +771,7 @@ class Evaluation_DataCollator:
                 continue
             if (v is not None) and (not isinstance(v, str)):
                 if (k == "kg_attention_mask"):
-                    if isinstance(v, torch.Tensor):
-                        if (len(v.shape) == 3):
-                            batch[k] = torch.stack([f[k] for f in features]).permute(0,3,1,2)
-                        else:
-                            batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
+                    batch[k] = collate_kg_attention_mask([f[k] for f in features])
                 else:
                     if isinstance(v, torch.Tensor):
                         batch[k] = torch.stack([f[k] for f in features])
@@ -1,9 +1,15 @@
 import random
 import json
+import hashlib
+import itertools
+import math
 import os
 import logging
 import pickle
+import shutil
 import time
+from glob import glob
+from multiprocessing import Pool
 import torch
 from filelock import FileLock
 from dataclasses import dataclass
@@ -11,7 +17,7 @@ from typing import Any, Callable, Dict, List, NewType, Optional, Tuple, Union
 from tqdm import tqdm
 import torch
 from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data.dataset import Dataset
+from torch.utils.data.dataset import ConcatDataset, Dataset, IterableDataset
 import numpy as np
 
 from transformers.tokenization_utils_base import BatchEncoding, PaddingStrategy, PreTrainedTokenizerBase
@@ -21,6 +27,10 @@ from .parameters import DataTrainingArguments
 
 logger = logging.getLogger(__name__)
 
+# --overwrite_cache only rebuilds caches older than this process, so that the processes of a distributed job, which
+# start together, rebuild a cache once and then load the rebuilt one
+_PROCESS_START_TIME = time.time()
+
 """
 Define Dataset & Load
 """
@@ -53,90 +63,384 @@ class InputFeatures:
         """Serializes this instance to a JSON string."""
         return json.dumps(dataclasses.asdict(self)) + "\n"
 
+def dense_mask_to_csr(mask) -> Dict[str, torch.Tensor]:
+    """
+    Compact (num_nodes, num_nodes) KG attention mask as CSR: row pointers and column indices of the nonzero entries.
+    The collators rebuild the dense mask only for the batch being built.
+    """
+    rows, cols = torch.as_tensor(mask).nonzero(as_tuple=True)
+    indptr = torch.cat([torch.zeros(1, dtype=torch.long), torch.bincount(rows, minlength=len(mask)).cumsum(0)])
+    return {'indptr': indptr, 'indices': cols.int()}
+
+def get_fast_tokenizer(tokenizer: PreTrainedTokenizer, sample_texts: List[str]) -> Optional[PreTrainedTokenizerBase]:
+    """
+    Fast (Rust) counterpart of a slow BERT-style tokenizer, built from its vocab file, options and added tokens.
+    None if it cannot be built, or if it does not tokenize sample_texts identically, so that the slow one is kept.
+    """
+    if tokenizer.is_fast:
+        return tokenizer
+    try:
+        from transformers import BertTokenizerFast
+        fast_tokenizer = BertTokenizerFast(
+            vocab_file=tokenizer.init_kwargs['vocab_file'],
+            do_lower_case=tokenizer.basic_tokenizer.do_lower_case,
+            tokenize_chinese_chars=tokenizer.basic_tokenizer.tokenize_chinese_chars,
+            strip_accents=tokenizer.init_kwargs.get('strip_accents'),
+            unk_token=tokenizer.unk_token,
+            sep_token=tokenizer.sep_token,
+            pad_token=tokenizer.pad_token,
+            cls_token=tokenizer.cls_token,
+            mask_token=tokenizer.mask_token,
+        )
+    except (ImportError, KeyError, AttributeError, OSError) as e:
+        logger.info(f"Cannot build a fast tokenizer ({e}), so that the slow tokenizer is used")
+        return None
+    for token, _ in sorted(tokenizer.added_tokens_encoder.items(), key=lambda x: x[1]):
+        if token in tokenizer.all_special_tokens:
+            fast_tokenizer.add_special_tokens({'additional_special_tokens': [token]})
+        else:
+            fast_tokenizer.add_tokens([token])
+
+    tokenizer_kwargs = dict(add_special_tokens=True, truncation=True, return_token_type_ids=False)
+    if fast_tokenizer.get_vocab() != tokenizer.get_vocab() or (
+        fast_tokenizer(sample_texts, **tokenizer_kwargs)['input_ids'] != tokenizer(sample_texts, **tokenizer_kwargs)['input_ids']
+    ):
+        logger.info("The fast tokenizer does not match the slow tokenizer, so that the slow tokenizer is used")
+        return None
+    return fast_tokenizer
+
+_worker_tokenizer = None
+
+def _init_tokenizer_worker(tokenizer: PreTrainedTokenizerBase):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+def _tokenize_chunk(texts: List[str], block_size: int) -> Dict[str, List[List[int]]]:
+    sample = _worker_tokenizer(texts, add_special_tokens=True, padding='max_length', truncation=True, max_length=block_size, return_token_type_ids=False)
+    return dict(sample)
+
+def write_columns(columns: Dict[str, list], output_dir: str):
+    """
+    Store each field of the samples as one contiguous array in output_dir: rectangular fields as a (num_samples, ...)
+    array, ragged ones (e.g. rc_indeces) as the concatenated values and (num_samples + 1) offsets along the first axis.
+    Fields of dicts such as CSR masks are stored as '<field>.<key>' columns.
+    """
+    os.makedirs(output_dir)
+    meta = {'num_samples': None, 'ragged': list()}
+    for name, values in columns.items():
+        if isinstance(values[0], dict):
+            write_columns({f"{name}.{k}": [v[k] for v in values] for k in values[0]}, os.path.join(output_dir, name))
+            continue
+        arrays = [np.asarray(v) for v in values]
+        meta['num_samples'] = len(arrays)
+        if all(a.shape == arrays[0].shape for a in arrays):
+            np.save(os.path.join(output_dir, f"{name}.npy"), np.stack(arrays))
+        else:
+            inner_shape = next((a.shape[1:] for a in arrays if a.size > 0), ())
+            arrays = [a.reshape((-1,) + inner_shape) for a in arrays]
+            offsets = np.cumsum([0] + [len(a) for a in arrays])
+            np.save(os.path.join(output_dir, f"{name}.npy"), np.concatenate(arrays))
+            np.save(os.path.join(output_dir, f"{name}.offsets.npy"), offsets)
+            meta['ragged'].append(name)
+    with open(os.path.join(output_dir, 'columns.json'), 'w') as f:
+        json.dump(meta, f)
+
+def load_columns(input_dir: str) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+    """
+    Memory-map the columns written by :func:`write_columns`, copy-on-write so that torch can wrap them without copies.
+    Returns (columns, offsets of the ragged columns).
+    """
+    columns, offsets = dict(), dict()
+    for root, _, files in os.walk(input_dir):
+        with open(os.path.join(root, 'columns.json')) as f:
+            meta = json.load(f)
+        for file_name in files:
+            if not file_name.endswith('.npy') or file_name.endswith('.offsets.npy'):
+                continue
+            name = file_name[:-len('.npy')]
+            columns[name] = np.load(os.path.join(root, file_name), mmap_mode='c')
+            if name in meta['ragged']:
+                offsets[name] = np.load(os.path.join(root, f"{name}.offsets.npy"))
+    return columns, offsets
+
 class HeadOnlyDataset(Dataset):
     """
-    This will be superseded by a framework-agnostic approach soon.
+    Columnar dataset: each field is a contiguous (memory-mapped) array, and ragged fields are indexed by offsets.
+    Samples are dicts of zero-copy tensor views, which DataLoader workers share with the main process.
     """
-    def __init__(self, tokenizer: PreTrainedTokenizer, file_path: str, block_size: int, token_type_vocab: dict = None):
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizer,
+        file_path: str,
+        block_size: int,
+        token_type_vocab: dict = None,
+        overwrite_cache: bool = False,
+        num_workers: Optional[int] = None,
+        use_fast_tokenizer: bool = False,
+    ):
         assert os.path.isdir(file_path), f"Input file path {file_path} not found"
-        # Here, we do not cache the features, operating under the assumption
-        # that we will soon use fast multithreaded tokenizers from the
-        # `tokenizers` repo everywhere =)
         self.token_type_vocab = token_type_vocab
         self.tokenizer = tokenizer
-        self.features = list()
-        # if not os.path.isfile(os.path.join(file_path,'cached_feature')):
-        logger.info("Creating features from dataset file at %s", file_path)
-        # Loading preprocessed data
-        self.batch_encoding = torch.load(os.path.join(file_path,'db'))
-        self.batch_encoding['lang'] = dict()
-        for text in tqdm(self.batch_encoding['text']):
-            sections, notes = list(text.keys()), list(text.values())
-            sample = tokenizer(f' {tokenizer.sep_token} '.join([x.strip() for x in notes]) , add_special_tokens=True, padding='max_length', truncation=True, max_length=block_size, return_token_type_ids=False)
-            if token_type_vocab:
-                sample['token_type_ids'] = self.generate_type_ids(sections, sample['input_ids'])
-            for k, v in sample.items():
-                if k not in self.batch_encoding['lang']:
-                    self.batch_encoding['lang'][k] = list()
-                self.batch_encoding['lang'][k].append(v)
-        self.batch2feature()
-        #     logger.info("Saving features...")
-        #     torch.save(self.features,os.path.join(file_path,'cached_feature'))
-        # else:
-        #     logger.info("Loading features from dataset file at %s", file_path)
-        #     self.features = torch.load(os.path.join(file_path,'cached_feature'))
-
-    def generate_type_ids(self, sections, tokens):
-        idx = 0
-        type_ids = list()
-        for token in tokens:
-            type_ids.append(self.token_type_vocab[sections[idx]])
-            if token == self.tokenizer.sep_token_id:
-                idx += 1
-                if idx >= len(sections):
-                    idx = len(sections)-1
-        return type_ids
-
-    def batch2feature(self):
-        for idx in tqdm(range(len(self.batch_encoding['input']))):
-            inputs = dict([('lang_'+k,self.batch_encoding['lang'][k][idx]) if 'token_type' not in k else (k, self.batch_encoding['lang'][k][idx]) for k in self.batch_encoding['lang']])
-            inputs['kg_input_ids'] = self.batch_encoding['input'][idx]
-            if 'mask' in self.batch_encoding:
-                inputs['kg_attention_mask'] = self.batch_encoding['mask'][idx]
-            if 'label' in self.batch_encoding:
-                if 'label_mask' in self.batch_encoding:
-                    inputs['kg_label'] = self.batch_encoding['label'][idx]
-                    inputs['kg_label_mask'] = self.batch_encoding['label_mask'][idx]
-                else:
-                    inputs['label'] = self.batch_encoding['label'][idx]
-            if 'rc_index' in self.batch_encoding:
-                inputs['rc_indeces'] = self.batch_encoding['rc_index'][idx]
-
-            feature = InputFeatures(**inputs)
-            self.features.append(feature)
+        self.use_fast_tokenizer = use_fast_tokenizer
+
+        # Features are cached next to the db, keyed by everything they depend on.
+        # The lock makes sure only the first process builds the cache, and the others load it.
+        # With overwrite_cache, a cache built after this process started is taken as already rebuilt by this job.
+        db_path = os.path.join(file_path, 'db')
+        cache_key = self.get_cache_key(tokenizer, db_path, block_size, token_type_vocab, use_fast_tokenizer)
+        cached_features_file = os.path.join(file_path, f"cached_features_{cache_key}")
+        lock_path = cached_features_file + ".lock"
+        with FileLock(lock_path):
+            if os.path.isdir(cached_features_file) and (
+                not overwrite_cache or os.path.getmtime(cached_features_file) >= _PROCESS_START_TIME
+            ):
+                logger.info(f"Loading features from cached directory {cached_features_file}")
+            else:
+                logger.info("Creating features from dataset file at %s", file_path)
+                # Loading preprocessed data
+                self.batch_encoding = torch.load(db_path)
+                if 'mask' in self.batch_encoding:
+                    # keep the graph structure as CSR, as dense masks cost num_nodes ** 2 floats per sample (older dbs)
+                    self.batch_encoding['mask'] = [
+                        mask if isinstance(mask, dict) or torch.as_tensor(mask).dim() != 2 else dense_mask_to_csr(mask)
+                        for mask in self.batch_encoding['mask']
+                    ]
+                sections = [list(text.keys()) for text in self.batch_encoding['text']]
+                texts = [
+                    f' {tokenizer.sep_token} '.join([x.strip() for x in text.values()]) for text in self.batch_encoding['text']
+                ]
+                self.batch_encoding['lang'] = self.tokenize(texts, block_size, num_workers)
+                if token_type_vocab:
+                    self.batch_encoding['lang']['token_type_ids'] = self.generate_type_ids(
+                        sections, self.batch_encoding['lang']['input_ids']
+                    )
+
+                start = time.time()
+                # write to a temporary directory first, so that an interrupted job does not leave a broken cache
+                for path in [cached_features_file + ".tmp", cached_features_file]:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                write_columns(self.batch2columns(), cached_features_file + ".tmp")
+                os.replace(cached_features_file + ".tmp", cached_features_file)
+                os.utime(cached_features_file) # mark the cache as built by this job
+                del self.batch_encoding
+                logger.info(
+                    "Saving features into cached directory %s [took %.3f s]", cached_features_file, time.time() - start
+                )
+            self.columns, self.offsets = load_columns(cached_features_file)
+        name = next(iter(self.columns))
+        self.num_samples = len(self.offsets[name]) - 1 if name in self.offsets else len(self.columns[name])
+
+    @staticmethod
+    def get_cache_key(
+        tokenizer: PreTrainedTokenizer,
+        db_path: str,
+        block_size: int,
+        token_type_vocab: dict = None,
+        use_fast_tokenizer: bool = False,
+    ) -> str:
+        """
+        Hash of the tokenizer vocab (with added tokens), whether the fast tokenizer is used, block_size,
+        token_type_vocab and the source db.
+        The source db is identified by its path, size and modification time rather than by its (large) contents.
+        """
+        db_stat = os.stat(db_path)
+        key = json.dumps(
+            {
+                'format': 'columnar',
+                'tokenizer': type(tokenizer).__name__,
+                'vocab': sorted(tokenizer.get_vocab().items()),
+                'use_fast_tokenizer': use_fast_tokenizer,
+                'block_size': block_size,
+                'token_type_vocab': token_type_vocab,
+                'db': [os.path.abspath(db_path), db_stat.st_size, db_stat.st_mtime_ns],
+            },
+            sort_keys=True,
+        )
+        return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def tokenize(self, texts: List[str], block_size: int, num_workers: Optional[int] = None) -> Dict[str, List[List[int]]]:
+        """
+        Batched tokenization of the notes, spread across num_workers processes.
+        With use_fast_tokenizer, the fast tokenizer is used if it matches the given one on a random sample of the notes.
+        """
+        tokenizer = self.tokenizer
+        if self.use_fast_tokenizer:
+            sample_texts = random.Random(0).sample(texts, min(len(texts), 1000))
+            tokenizer = get_fast_tokenizer(self.tokenizer, sample_texts) or self.tokenizer
+        logger.info(f"Tokenize {len(texts)} notes with {type(tokenizer).__name__}")
+        if num_workers is None or num_workers <= 1:
+            _init_tokenizer_worker(tokenizer)
+            return _tokenize_chunk(texts, block_size)
+
+        chunk_size = math.ceil(len(texts) / (num_workers * 4))
+        chunks = [(texts[start:start + chunk_size], block_size) for start in range(0, len(texts), chunk_size)]
+        with Pool(num_workers, initializer=_init_tokenizer_worker, initargs=(tokenizer,)) as pool:
+            samples = pool.starmap(_tokenize_chunk, tqdm(chunks))
+        return {k: [v for sample in samples for v in sample[k]] for k in samples[0]}
+
+    def generate_type_ids(self, sections: List[List[str]], input_ids: List[List[int]]) -> List[List[int]]:
+        """
+        Section type ids of the tokens, where the i-th section spans up to its [SEP], i.e. the number of [SEP]s before
+        a token is its section index. Tokens after the last section (e.g. padding) keep the type of the last section.
+        """
+        input_ids = np.asarray(input_ids)
+        is_sep = (input_ids == self.tokenizer.sep_token_id).astype(np.int64)
+        num_sections = np.array([len(s) for s in sections])
+        section_idx = np.minimum(np.cumsum(is_sep, axis=1) - is_sep, (num_sections - 1)[:, None])
+        section_types = np.zeros((len(sections), num_sections.max()), dtype=np.int64)
+        for idx, sample_sections in enumerate(sections):
+            section_types[idx, :len(sample_sections)] = [self.token_type_vocab[section] for section in sample_sections]
+        return np.take_along_axis(section_types, section_idx, axis=1).tolist()
+
+    def batch2columns(self) -> Dict[str, list]:
+        """ Fields of all samples, named as the corresponding inputs to a model """
+        columns = dict()
+        for k, v in self.batch_encoding['lang'].items():
+            columns[k if 'token_type' in k else 'lang_' + k] = v
+        columns['kg_input_ids'] = self.batch_encoding['input']
+        if 'mask' in self.batch_encoding:
+            columns['kg_attention_mask'] = self.batch_encoding['mask']
+        if 'label' in self.batch_encoding:
+            if 'label_mask' in self.batch_encoding:
+                columns['kg_label'] = self.batch_encoding['label']
+                columns['kg_label_mask'] = self.batch_encoding['label_mask']
+            else:
+                columns['label'] = self.batch_encoding['label']
+        if 'rc_index' in self.batch_encoding:
+            columns['rc_indeces'] = self.batch_encoding['rc_index']
+        return columns
 
     def __len__(self):
-        return len(self.features)
+        return self.num_samples
+
+    def __getitem__(self, i) -> Dict[str, Union[torch.Tensor, Dict[str, torch.Tensor]]]:
+        sample = dict()
+        for name, values in self.columns.items():
+            if name in self.offsets:
+                value = values[self.offsets[name][i]:self.offsets[name][i + 1]]
+            else:
+                value = values[i, ...]
+            value = torch.from_numpy(value)
+            if '.' in name:
+                field, key = name.split('.', 1)
+                sample.setdefault(field, dict())[key] = value
+            else:
+                sample[name] = value
+        return sample
+
+class StreamingHeadOnlyDataset(IterableDataset):
+    """
+    Stream over sharded dataset directories (each one as for :class:`HeadOnlyDataset`), for corpora which do not fit in
+    memory at once. Shards are opened lazily one at a time, and samples are shuffled with a bounded buffer.
+    Shards are split across DDP ranks and DataLoader workers (or the samples of each shard, when there are fewer shards
+    than readers). Readers may hold different numbers of samples, so every reader streams endlessly, reshuffling the
+    shards on each pass: DDP ranks then never run out of samples at different steps, and training is driven by max_steps.
+    """
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizer,
+        file_paths: List[str],
+        block_size: int,
+        token_type_vocab: dict = None,
+        shuffle_buffer_size: int = 1000,
+        seed: int = 0,
+        rank: Optional[int] = None,
+        world_size: Optional[int] = None,
+        use_fast_tokenizer: bool = False,
+    ):
+        if len(file_paths) == 0:
+            raise ValueError("No shards are given for the streaming dataset")
+        self.tokenizer = tokenizer
+        self.file_paths = list(file_paths)
+        self.block_size = block_size
+        self.token_type_vocab = token_type_vocab
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.use_fast_tokenizer = use_fast_tokenizer
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        self.rank = rank if rank is not None else (torch.distributed.get_rank() if distributed else 0)
+        self.world_size = world_size if world_size is not None else (torch.distributed.get_world_size() if distributed else 1)
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info is not None else (1, 0)
+        num_readers, reader_id = self.world_size * num_workers, self.rank * num_workers + worker_id
+
+        rng = random.Random((self.seed + self.epoch) * num_readers + reader_id)
+        buffer = list()
+        for num_pass in itertools.count(self.epoch):
+            # every reader shuffles the shards in the same way, so that each shard is read by exactly one of them
+            file_paths = list(self.file_paths)
+            random.Random(self.seed + num_pass).shuffle(file_paths)
+            if len(file_paths) >= num_readers:
+                file_paths, sample_offset, sample_stride = file_paths[reader_id::num_readers], 0, 1
+            else:
+                sample_offset, sample_stride = reader_id, num_readers
 
-    def __getitem__(self, i) -> InputFeatures:
-        return self.features[i]
+            num_samples = 0
+            for file_path in file_paths:
+                # features of the shard are built once (under its lock) and memory-mapped afterwards
+                dataset = HeadOnlyDataset(
+                    tokenizer=self.tokenizer,
+                    file_path=file_path,
+                    block_size=self.block_size,
+                    token_type_vocab=self.token_type_vocab,
+                    use_fast_tokenizer=self.use_fast_tokenizer,
+                )
+                indices = list(range(sample_offset, len(dataset), sample_stride))
+                rng.shuffle(indices)
+                num_samples += len(indices)
+                for idx in indices:
+                    sample = dataset[idx]
+                    if len(buffer) < self.shuffle_buffer_size:
+                        buffer.append(sample)
+                        continue
+                    pos = rng.randrange(len(buffer))
+                    yield buffer[pos]
+                    buffer[pos] = sample
+            if num_samples == 0:
+                raise ValueError(f"Reader {reader_id} of {num_readers} gets no samples from the streaming dataset")
 
 def get_dataset(
     args: DataTrainingArguments,
     tokenizer: PreTrainedTokenizer,
     evaluate: bool = False,
     test: bool = False,
-    token_type_vocab: dict = None
+    token_type_vocab: dict = None,
+    seed: int = 0,
 ):
     def _dataset(file_path):
-        return HeadOnlyDataset(tokenizer=tokenizer, file_path=file_path, block_size=args.block_size, token_type_vocab=token_type_vocab)
+        return HeadOnlyDataset(
+            tokenizer=tokenizer,
+            file_path=file_path,
+            block_size=args.block_size,
+            token_type_vocab=token_type_vocab,
+            overwrite_cache=args.overwrite_cache,
+            num_workers=args.preprocessing_num_workers,
+            use_fast_tokenizer=args.use_fast_tokenizer,
+        )
 
     if evaluate:
         return _dataset(args.eval_data_file)
     if test:
         return _dataset(args.test_data_file)
+    elif args.train_data_files and args.streaming:
+        return StreamingHeadOnlyDataset(
+            tokenizer=tokenizer,
+            file_paths=sorted(glob(args.train_data_files)),
+            block_size=args.block_size,
+            token_type_vocab=token_type_vocab,
+            shuffle_buffer_size=args.shuffle_buffer_size,
+            seed=seed,
+            use_fast_tokenizer=args.use_fast_tokenizer,
+        )
     elif args.train_data_files:
-        return ConcatDataset([_dataset(f) for f in glob(args.train_data_files)])
+        return ConcatDataset([_dataset(f) for f in sorted(glob(args.train_data_files))])
     else:
         return _dataset(args.train_data_file)
 
@@ -90,5 +90,20 @@ class DataTrainingArguments:
     overwrite_cache: bool = field(
         default=False, metadata={"help": "Overwrite the cached training and evaluation sets"}
     )
+    streaming: bool = field(
+        default=False,
+        metadata={"help": "Stream the shards of train_data_files instead of loading them at once (requires max_steps)."},
+    )
+    shuffle_buffer_size: int = field(
+        default=1000, metadata={"help": "Number of samples in the shuffle buffer of the streaming dataset."}
+    )
+    preprocessing_num_workers: Optional[int] = field(
+        default=None, metadata={"help": "Number of processes tokenizing the notes when building features."}
+    )
+    use_fast_tokenizer: bool = field(
+        default=False,
+        metadata={"help": "Tokenize the notes with the fast (Rust) tokenizer when building features, if it matches "
+                          "the slow tokenizer on a random sample of the notes."},
+    )
 
 parser = HfArgumentParser((ModelArguments, DataTrainingArguments, TrainingArguments))
\ No newline at end of file
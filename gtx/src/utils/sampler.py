@@ -0,0 +1,144 @@
+import math
+import logging
+from typing import Iterator, List, Optional, Tuple
+
+import torch
+import torch.distributed as dist
+from torch.utils.data.dataset import Dataset
+from torch.utils.data.sampler import Sampler
+
+logger = logging.getLogger(__name__)
+
+"""
+Length-bucketed batch samplers with a token budget
+"""
+def get_sample_lengths(dataset: Dataset, kg_pad_token_id: int) -> List[Tuple[int, int]]:
+    """
+    (text length, KG length) of each sample, without padding.
+    The text length is taken from lang_attention_mask (or lang_input_ids), the KG length counts non-[PAD] nodes.
+    """
+    lengths = list()
+    for idx in range(len(dataset)):
+        feature = dataset[idx]
+        if not isinstance(feature, dict):
+            feature = vars(feature)
+        if feature.get('lang_attention_mask') is not None:
+            lang_length = int(torch.as_tensor(feature['lang_attention_mask']).sum())
+        else:
+            lang_length = len(feature['lang_input_ids'])
+        kg_length = int(torch.as_tensor(feature['kg_input_ids']).ne(kg_pad_token_id).sum())
+        lengths.append((lang_length, kg_length))
+    return lengths
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Batch sampler which groups samples of similar (text length, KG length) into buckets, shuffles within buckets, and
+    fills each batch until its padded size, batch_size * (longest text + longest KG), would exceed max_tokens.
+    Together with dynamic padding of the collators, batches have a similar number of tokens regardless of lengths.
+
+    Args:
+        lengths: (text length, KG length) of each sample, see :func:`get_sample_lengths`.
+        max_tokens: Token budget of a batch. A sample longer than the budget makes a batch by itself.
+        max_batch_size: (Optional) Maximum number of samples in a batch.
+        bucket_width: Length range of a bucket, in both the text and the KG length.
+        shuffle: Whether to shuffle samples within buckets and the order of batches.
+        seed: Random seed, combined with the epoch set by :meth:`set_epoch`.
+    """
+    def __init__(
+        self,
+        lengths: List[Tuple[int, int]],
+        max_tokens: int,
+        max_batch_size: Optional[int] = None,
+        bucket_width: int = 32,
+        shuffle: bool = True,
+        seed: int = 0,
+    ):
+        if max_tokens <= 0:
+            raise ValueError(f"max_tokens should be a positive integer, but got {max_tokens}")
+        self.lengths = torch.as_tensor(lengths, dtype=torch.long).view(-1, 2)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.bucket_width = bucket_width
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch: int):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._batches = None
+
+    def make_batches(self) -> List[List[int]]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        # buckets of (text length, KG length) ranges, where the random order within a bucket is kept by sorting on
+        # (bucket, position in the random order)
+        num_samples = len(self.lengths)
+        order = torch.randperm(num_samples, generator=generator) if self.shuffle else torch.arange(num_samples)
+        bucket_ids = self.lengths[order] // self.bucket_width
+        bucket_keys = bucket_ids[:, 0] * (int(bucket_ids[:, 1].max()) + 1 if num_samples > 0 else 1) + bucket_ids[:, 1]
+        sorted_idx = torch.argsort(bucket_keys * num_samples + torch.arange(num_samples))
+        order, sorted_keys = order[sorted_idx].tolist(), bucket_keys[sorted_idx].tolist()
+
+        lengths = self.lengths.tolist()
+        batches, batch, batch_max, batch_key = list(), list(), (0, 0), None
+        for idx, key in zip(order, sorted_keys):
+            lang_length, kg_length = lengths[idx]
+            new_max = (max(batch_max[0], lang_length), max(batch_max[1], kg_length))
+            full = (len(batch) + 1) * sum(new_max) > self.max_tokens or (
+                self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            )
+            if batch and (key != batch_key or full):
+                batches.append(batch)
+                batch, new_max = list(), (lang_length, kg_length)
+            batch.append(idx)
+            batch_max, batch_key = new_max, key
+        if batch:
+            batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return batches
+
+    @property
+    def batches(self) -> List[List[int]]:
+        if self._batches is None:
+            self._batches = self.make_batches()
+        return self._batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self.batches)
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+class DistributedTokenBudgetBatchSampler(TokenBudgetBatchSampler):
+    """
+    Distributed version of :class:`TokenBudgetBatchSampler`, used in place of DistributedSampler.
+    Every process builds the same batches from the shared seed and epoch, and takes every num_replicas-th batch.
+    Batches are repeated from the start so that all processes run the same number of steps.
+    """
+    def __init__(
+        self,
+        lengths: List[Tuple[int, int]],
+        max_tokens: int,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        **kwargs,
+    ):
+        if num_replicas is None or rank is None:
+            if not dist.is_available() or not dist.is_initialized():
+                raise RuntimeError("Requires distributed package to be available and initialized")
+            num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+            rank = dist.get_rank() if rank is None else rank
+        super().__init__(lengths, max_tokens, **kwargs)
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def make_batches(self) -> List[List[int]]:
+        batches = super().make_batches()
+        num_batches = math.ceil(len(batches) / self.num_replicas) * self.num_replicas
+        batches = (batches * math.ceil(num_batches / max(len(batches), 1)))[:num_batches]
+        return batches[self.rank:num_batches:self.num_replicas]
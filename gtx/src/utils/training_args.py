@@ -130,6 +130,18 @@ class TrainingArguments:
         dataloader_num_workers (:obj:`int`, `optional`, defaults to 0):
             Number of subprocesses to use for data loading (PyTorch only). 0 means that the data will be loaded in the
             main process.
+        max_tokens_per_batch (:obj:`int`, `optional`):
+            If set, training batches are built by :class:`~utils.sampler.TokenBudgetBatchSampler`, which groups samples
+            of similar text and KG lengths and fills each batch up to this number of (padded) tokens, with at most
+            :obj:`train_batch_size` samples.
+        length_bucket_width (:obj:`int`, `optional`, defaults to 32):
+            Length range of the buckets of the token-budget batch sampler.
+        num_decode_workers (:obj:`int`, `optional`, defaults to 0):
+            Number of CPU processes decoding contiguous shards of the dataset in :obj:`evaluation_generation.py`, each
+            with its own model copy. 0 or 1 means decoding in the main process on :obj:`device`.
+        decode_num_threads (:obj:`int`, `optional`):
+            Number of intra-op threads of each decoding worker. Will default to the number of cores divided by
+            :obj:`num_decode_workers`.
         past_index (:obj:`int`, `optional`, defaults to -1):
             Some models like :doc:`TransformerXL <../model_doc/transformerxl>` or :doc`XLNet <../model_doc/xlnet>` can
             make use of the past hidden states for their predictions. If this argument is set to a positive int, the
@@ -304,6 +316,20 @@ class TrainingArguments:
             "help": "Number of subprocesses to use for data loading (PyTorch only). 0 means that the data will be loaded in the main process."
         },
     )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={"help": "If set, batch samples of similar lengths under this token budget instead of a fixed batch size."},
+    )
+    length_bucket_width: int = field(
+        default=32, metadata={"help": "Length range of the buckets of the token-budget batch sampler."}
+    )
+    num_decode_workers: int = field(
+        default=0,
+        metadata={"help": "Number of CPU processes decoding shards of the dataset for generation. 0 or 1 means the main process."},
+    )
+    decode_num_threads: Optional[int] = field(
+        default=None, metadata={"help": "Number of threads of each decoding worker (defaults to #cores / num_decode_workers)."}
+    )
 
     past_index: int = field(
         default=-1,